@@ -34,6 +34,8 @@ def _install_import_stubs() -> None:
             pass
 
         openai_stub.OpenAI = OpenAI
+        for name in ["APIConnectionError", "RateLimitError", "InternalServerError"]:
+            setattr(openai_stub, name, type(name, (Exception,), {}))
         sys.modules["openai"] = openai_stub
 
 
@@ -0,0 +1,100 @@
+"""Columnar query results.
+
+Rows are retrieved from a cursor in chunks, and each chunk is
+transposed into typed NumPy arrays (one per column) so that the rows
+themselves can be discarded. Integer, floating point, decimal, boolean
+and date/time columns are stored in native arrays; other columns
+(including text) are stored in arrays of python objects. The result
+can be converted to a pandas or polars DataFrame or an Arrow table.
+
+Requires numpy; pandas, polars or pyarrow are required only for the
+corresponding conversion.
+
+"""
+
+import logging
+from datetime import date, datetime
+from decimal import Decimal
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+# maps python types reported in cursor.description to numpy dtypes
+DTYPES = {
+    bool: 'bool',
+    int: 'int64',
+    float: 'float64',
+    Decimal: 'float64',
+    datetime: 'datetime64[us]',
+    date: 'datetime64[D]',
+}
+
+
+class ColumnBuffer:
+    """Accumulates the values of a column as a list of arrays"""
+
+    def __init__(self, name: str, type_code=None):
+        self.name = name
+        self.dtype = DTYPES.get(type_code)
+        self.chunks = []
+
+    def append(self, values: tuple):
+        dtype = self.dtype
+        if dtype in {'int64', 'bool'} and None in values:
+            # integer columns with nulls are stored as floats (with
+            # nulls as NaN); boolean columns as objects
+            dtype = 'float64' if dtype == 'int64' else object
+        # None is converted to NaN or NaT for float and datetime types
+        self.chunks.append(np.array(values, dtype=dtype or object))
+
+    def array(self):
+        if not self.chunks:
+            return np.array([], dtype=self.dtype or object)
+        return np.concatenate(self.chunks)
+
+
+class ColumnarResult:
+    """Column names and a dict of arrays keyed by column name"""
+
+    def __init__(self, headers: list, columns: dict):
+        self.headers = headers
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns[self.headers[0]]) if self.headers else 0
+
+    def to_pandas(self):
+        import pandas as pd
+        return pd.DataFrame(self.columns, columns=self.headers, copy=False)
+
+    def to_polars(self):
+        import polars as pl
+        return pl.DataFrame([pl.Series(name, self.columns[name]) for name in self.headers])
+
+    def to_arrow(self):
+        import pyarrow as pa
+        return pa.table([pa.array(self.columns[name]) for name in self.headers],
+                        names=self.headers)
+
+
+def from_chunks(description, chunks) -> ColumnarResult:
+    """Build a ColumnarResult from `description` (a sequence of tuples
+    (name, type_code, ...) as provided by cursor.description) and an
+    iterable of lists of rows.
+
+    """
+
+    if np is None:
+        raise ImportError('numpy is required for columnar results')
+
+    buffers = [ColumnBuffer(desc[0], desc[1]) for desc in description]
+    for chunk in chunks:
+        for buffer, values in zip(buffers, zip(*chunk)):
+            buffer.append(values)
+
+    headers = [buffer.name for buffer in buffers]
+    return ColumnarResult(headers, {buffer.name: buffer.array() for buffer in buffers})
@@ -26,6 +26,27 @@ test.sql  test-2023-03-01.csv
 $ cat test-2023-03-01.csv
 col1,col2
 1,2023-03-01
+
+Use --bcp to export the query using the bcp utility in character mode,
+which avoids the UTF-16 intermediate file and is much faster for large
+results. Fields and rows are delimited by control characters that are
+unlikely to appear in the data, and the output is converted to csv as
+it is read. Column names are obtained using
+sp_describe_first_result_set, so the query must be a single select
+statement.
+
+A large export can be split into parts exported in parallel by
+providing a range of values for an integer key (--key-range LO:HI,
+inclusive) and a number of parts (--parallel N). The query must
+restrict the key using the placeholders {key_lo} and {key_hi}, which
+are replaced with the bounds of each part (key_lo <= key < key_hi).
+Parts are written to the output in order of the key range:
+
+$ cat notes.sql
+select NOTE_ID, CONTACT_DATE from clarity.HNO_INFO
+where NOTE_ID >= {key_lo} and NOTE_ID < {key_hi}
+
+$ sql2csv.py -i notes.sql --bcp --key-range 1:50000000 --parallel 8 -o notes.csv.gz
 """
 
 import os
@@ -36,6 +57,8 @@ import gzip
 from subprocess import run, CalledProcessError
 import tempfile
 import logging
+import shutil
+from subprocess import Popen
 
 from dawgtools.utils import StdOut
 
@@ -54,11 +77,116 @@ while True:
         field_size_limit = int(field_size_limit / 10)
 
 
+SERVER = 'am-dawg-sql-trt'
+
+# bcp field and row terminators (ASCII unit and record separators)
+FIELD_TERM = '\x1f'
+ROW_TERM = '\x1e'
+
+
 def nonull(row, maxchars=1000):
     """Replace NULL with '' and limit other values to maxchars characters."""
     return ['' if x == 'NULL' else x[:maxchars] for x in row]
 
 
+def key_ranges(lo: int, hi: int, n: int) -> list[tuple[int, int]]:
+    """Split the inclusive range [lo, hi] into at most n contiguous
+    half-open ranges [key_lo, key_hi).
+
+    """
+    n = max(min(n, hi - lo + 1), 1)
+    bounds = [lo + (hi + 1 - lo) * i // n for i in range(n + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def bcp_cmd(bcp: str, query: str, outfile: str) -> list[str]:
+    # https://learn.microsoft.com/en-us/sql/tools/bcp-utility
+    return [
+        bcp, query, 'queryout', outfile,
+        '-S', SERVER,
+        '-T',
+        '-c',
+        '-t', FIELD_TERM,
+        '-r', ROW_TERM,
+    ]
+
+
+def read_bcp(path: str, chunk_size: int = 1 << 20):
+    """Yields rows from a file written by bcp in character mode. Null
+    values and empty strings (represented by bcp as a NUL character)
+    are both returned as empty strings.
+
+    """
+    with open(path, encoding='utf-8', errors='replace', newline='') as f:
+        remainder = ''
+        while chunk := f.read(chunk_size):
+            records = (remainder + chunk).split(ROW_TERM)
+            remainder = records.pop()
+            for record in records:
+                yield record.replace('\x00', '').split(FIELD_TERM)
+        if remainder:
+            yield remainder.replace('\x00', '').split(FIELD_TERM)
+
+
+def bcp_headers(bcp: str, query: str, workdir: str) -> list[str]:
+    """Return column names of the result of `query`"""
+    describe = "exec sp_describe_first_result_set N'{}'".format(query.replace("'", "''"))
+    outfile = os.path.join(workdir, 'headers')
+    run(bcp_cmd(bcp, describe, outfile), check=True, capture_output=True)
+    # columns of the result are is_hidden, column_ordinal, name, ...
+    rows = sorted((row for row in read_bcp(outfile) if row[0] == '0'),
+                  key=lambda row: int(row[1]))
+    return [row[2] for row in rows]
+
+
+def bcp_export(query: str, f, bcp: str = 'bcp', ranges: list | None = None):
+    """Export the results of `query` to file object `f` in csv format
+    using bcp. If `ranges` is provided, export one part for each range
+    (key_lo, key_hi) in parallel, substituting the bounds for the
+    placeholders {key_lo} and {key_hi} in the query.
+
+    """
+
+    workdir = tempfile.mkdtemp()
+    try:
+        if ranges:
+            queries = [query.replace('{key_lo}', str(lo)).replace('{key_hi}', str(hi))
+                       for lo, hi in ranges]
+        else:
+            queries = [query]
+
+        headers = bcp_headers(bcp, queries[0], workdir)
+
+        # bcp reports progress on stdout, so save it to a log file for
+        # each part to keep it out of the output
+        parts = [os.path.join(workdir, f'part{i}') for i in range(len(queries))]
+        procs = []
+        for q, part in zip(queries, parts):
+            with open(part + '.log', 'w') as logfile:
+                procs.append(Popen(bcp_cmd(bcp, q, part), stdout=logfile, stderr=logfile))
+        for proc, part in zip(procs, parts):
+            if proc.wait() != 0:
+                with open(part + '.log') as logfile:
+                    sys.stderr.write(logfile.read())
+                raise CalledProcessError(proc.returncode, proc.args)
+
+        writer = csv.writer(f, dialect='unix', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(headers)
+        rowlen = len(headers)
+        malformed = 0
+        for part in parts:
+            for row in read_bcp(part):
+                if len(row) == rowlen:
+                    writer.writerow(row)
+                else:
+                    malformed += 1
+        if malformed:
+            log.warning(f'Warning: dropped {malformed} rows with a number of fields '
+                        f'differing from {rowlen}')
+    finally:
+        shutil.rmtree(workdir)
+
+
 def build_parser(parser):
     parser.add_argument('-q', '--query', help="sql command")
     parser.add_argument('-i', '--infile', help="Input file containing an sql command")
@@ -73,17 +201,38 @@ def build_parser(parser):
                         help="""One or more variable value pairs in
                         the form -e var=val; these are used as format
                         string arguments when rendering the query.""")
+    parser.add_argument('--bcp', action='store_true', default=False,
+                        help='Export using bcp instead of sqlcmd')
+    parser.add_argument('--bcp-path', default='bcp',
+                        help='Path to the bcp executable [%(default)s]')
+    parser.add_argument('--key-range', metavar='LO:HI',
+                        help="""Inclusive range of an integer key used to
+                        split a --bcp export into parts""")
+    parser.add_argument('--parallel', metavar='N', type=int, default=4,
+                        help="""Number of parts to export in parallel
+                        with --key-range [%(default)s]""")
 
 
-def action(args):
-    tempoutfile, tempout = tempfile.mkstemp()
-    os.close(tempoutfile)
+def output_opener(outfile):
+    """Return (outfile, opener) for writing to `outfile`, or stdout"""
+    if outfile is None:
+        return None, StdOut
+    elif outfile.endswith('.gz'):
+        return outfile, gzip.open
+    else:
+        return outfile, open
 
+
+def action(args):
     if args.environment:
         environment = dict([var.split('=') for var in args.environment])
     else:
         environment = {}
 
+    if args.key_range:
+        # retain placeholders for substitution in each part
+        environment.update(key_lo='{key_lo}', key_hi='{key_hi}')
+
     if args.query:
         query_text = args.query
     elif args.infile:
@@ -99,6 +248,27 @@ def action(args):
     if args.dry_run:
         return
 
+    outfile, opener = output_opener(
+        args.outfile.format(**environment) if args.outfile else None)
+
+    if args.bcp:
+        if args.key_range:
+            lo, hi = (int(x) for x in args.key_range.split(':'))
+            ranges = key_ranges(lo, hi, args.parallel)
+        else:
+            ranges = None
+
+        try:
+            with opener(outfile, 'wt', encoding='utf-8', errors='ignore', newline='') as f:
+                bcp_export(query_text, f, bcp=args.bcp_path, ranges=ranges)
+        except CalledProcessError as err:
+            print(err)
+            return 1
+        return
+
+    tempoutfile, tempout = tempfile.mkstemp()
+    os.close(tempoutfile)
+
     with tempfile.NamedTemporaryFile('w', delete=False) as sqltemp:
         sqltemp.write('SET NOCOUNT ON;\n\n')
         sqltemp.write(query_text)
@@ -107,7 +277,7 @@ def action(args):
         # https://learn.microsoft.com/en-us/sql/tools/sqlcmd-utility?view=sql-server-ver16
         cmd = [
             'sqlcmd',
-            '-S', 'am-dawg-sql-trt',
+            '-S', SERVER,
             '-i', sqltemp.name,
             '-o', tempout,
             '-s', '|',
@@ -121,16 +291,6 @@ def action(args):
 
         run(cmd, check=True)
 
-        if args.outfile:
-            outfile = args.outfile.format(**environment)
-            if outfile.endswith('.gz'):
-                opener = gzip.open
-            else:
-                opener = open
-        else:
-            outfile = None
-            opener = StdOut
-
         with (open(tempout, 'r', encoding='utf-16') as tempin,
               opener(outfile, 'wt', encoding='utf-8', errors='ignore') as f):
             reader = csv.reader(tempin, delimiter='|')
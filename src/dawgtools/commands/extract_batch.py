@@ -26,6 +26,111 @@ A cache directory is created to store intermediate results and avoid re-querying
 the model for files that have already been processed. New model queries are
 performed each time the schema file changes.
 
+Validation
+----------
+
+Each result is validated against the ``parameters`` of the schema.
+Files for which the model returned malformed or invalid arguments
+(for example, missing required properties) are reported in the
+summary and recorded in the manifest in the cache directory (see
+below). The arguments returned for these files are still written to
+the output (or a blank row if none could be parsed), with the problems
+described in the ``errors`` column. Requests that still fail after
+``--max-retries`` retries are recorded in the same way, so that the
+results of other files are not lost. Use ``--retry-invalid`` to request
+features again for only those files, loading all other results from
+the cache::
+
+  dawgtools extract_batch schema.json -d input_texts -o features.csv --retry-invalid
+
+Deduplication
+-------------
+
+Clinical notes often contain copied-forward text, so a directory of
+inputs may contain many identical or nearly identical files. Use
+``--dedup exact`` to group files with identical text (ignoring
+differences in whitespace), or ``--dedup near`` to also group files
+whose word 5-grams have an estimated Jaccard similarity of at least
+``--similarity`` (using MinHash and locality-sensitive hashing). Only
+the first file in each group is sent to the model; its features are
+written for every member of the group, and the ``representative``
+column identifies the file that was processed::
+
+  dawgtools extract_batch schema.json -d input_texts -o features.csv --dedup near
+
+Sharding
+--------
+
+Use ``--shard K/N`` to process only the K-th of N shards of the sorted
+list of input files. Files are assigned to shards using a stable hash
+of the file name, so several machines can each process one shard
+without coordination. Each shard writes its own output file, and a
+manifest named ``manifest-K-of-N.json`` in the cache directory
+describing the shard (a run without ``--shard`` writes
+``manifest.json``). When combined with ``--dedup``, files are grouped
+only within each shard. Combine the shards using ``extract_merge``::
+
+  # on each of four machines (K = 1, 2, 3, 4)
+  dawgtools extract_batch schema.json -d input_texts --shard K/4 -o features-K.csv
+
+  # after collecting the outputs and manifests in one directory
+  dawgtools extract_merge manifest-*-of-4.json -o features.csv
+
+Hedged requests
+---------------
+
+A small fraction of model requests may take much longer than the rest.
+Use ``--hedge PCT`` to issue a duplicate request when a request has been
+running for longer than the PCT percentile of latencies observed so far
+in the run (once at least 10 requests have completed); the result of
+whichever request finishes first is used. The number of duplicate
+requests is limited by ``--hedge-max`` (by default, 10% of the files to
+be processed)::
+
+  dawgtools extract_batch schema.json -d input_texts -o features.csv --hedge 95
+
+Telemetry
+---------
+
+A progress line showing throughput, estimated time remaining, and
+tokens per minute is displayed when stderr is a terminal, and a summary
+of cache hits, token usage and request latency is printed at the end of
+the run. Use ``--metrics`` to write one record per processed file
+(JSONL, or CSV if the file name ends with ``.csv``) containing the
+file name, model, cache hit or miss, request latency in seconds, input,
+output and cached input token counts, and number of retries::
+
+  dawgtools extract_batch schema.json -d input_texts -o features.csv --metrics metrics.jsonl
+
+Comparing models
+----------------
+
+Repeat ``-m/--model`` to process the same input files with each model
+in a single run. Files are read once, and requests for each model are
+made concurrently, each model with its own pool of ``-j/--workers``
+concurrent requests and optional rate limit (``--rpm``, requests per
+minute), so that the run takes about as long as the slowest model.
+The output contains one row per file and model (identified in the
+``model`` column), or with ``--wide``, one row per file with a column
+named ``<model>.<feature>`` for each model and feature. Latency and
+token usage are summarized for each model::
+
+  dawgtools extract_batch schema.json -d input_texts -o features.csv -m gpt-5.2 -m gpt-5-mini
+
+Prompt caching
+--------------
+
+Model providers can reuse the processing of a prompt prefix shared with
+recent requests. The tool schema and the ``--prompt`` content are the
+same for every file, so by default the prompt is sent before the
+document (``--order prompt-first``) so that only the document differs
+between requests. Requests sent to the OpenAI API also include a prompt
+cache key derived from the schema and prompt; the key is not sent to
+other endpoints set using ``OPENAI_BASE_URL``, which may not accept
+it. Use ``--order document-first`` to send the document before the
+prompt. The number of cached input tokens is reported in the summary
+and in the ``--metrics`` output.
+
 Schema format
 -------------
 
@@ -58,6 +163,10 @@ Example schema (from the OpenAI documentation):
      }
    }
 
+The names ``filename``, ``representative``, ``model`` and ``errors``
+are used for other columns of the output, and may not be used as
+property names.
+
 """
 
 import argparse
@@ -66,8 +175,63 @@ import json
 from pathlib import Path
 import csv
 import hashlib
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+
+from openai import OpenAI, OpenAIError, APIConnectionError, RateLimitError, InternalServerError
+
+from dawgtools import dedup
+from dawgtools.hedge import Hedger
+from dawgtools.schema import compile_schema
+from dawgtools.metrics import MetricsWriter, Progress, usage_counts
+
+RETRY_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
+# columns of the output other than features, which may not be used as
+# names of properties in the schema
+OUTPUT_COLUMNS = {'filename', 'representative', 'model', 'errors'}
+
+
+def parse_shard(shard: str) -> tuple[int, int]:
+    """Parse a string 'K/N' into a tuple (K, N) with 1 <= K <= N"""
+    try:
+        k, n = (int(x) for x in shard.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'shard must be in the form K/N, got "{shard}"')
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError(f'shard K/N requires 1 <= K <= N, got "{shard}"')
+    return k, n
+
 
-from openai import OpenAI
+def shard_of(path: Path, nshards: int) -> int:
+    """Return the 1-based shard to which `path` is assigned using a
+    hash of the file name that is stable across machines and runs.
+
+    """
+    digest = hashlib.md5(path.name.encode('utf-8')).hexdigest()
+    return int(digest, 16) % nshards + 1
+
+
+def manifest_name(shard: tuple[int, int] | None) -> str:
+    return 'manifest-{}-of-{}.json'.format(*shard) if shard else 'manifest.json'
+
+
+def inputs_digest(files: list[Path]) -> str:
+    """Identifies the complete set of input files shared by all shards"""
+    return hashlib.md5('\n'.join(f.name for f in files).encode('utf-8')).hexdigest()
+
+
+def is_openai_endpoint(client: OpenAI) -> bool:
+    """True if `client` sends requests to the OpenAI API rather than
+    to a compatible endpoint
+
+    """
+    base_url = getattr(client, 'base_url', None)
+    return base_url is not None and base_url.host == 'api.openai.com'
 
 
 def get_features(client: OpenAI,
@@ -75,12 +239,23 @@ def get_features(client: OpenAI,
                  tools: list,
                  model: str,
                  prompt: str = None,
+                 order: str = 'prompt-first',
                  **kwargs) -> dict:
+    """Request features for `content`. The optional `prompt` is sent
+    before the document if `order` is 'prompt-first', so that requests
+    for different documents share a common prefix, or after the
+    document if `order` is 'document-first'.
+
+    """
 
     messages = [{'role': 'user', 'content': content}]
 
     if prompt:
-        messages.append({'role': 'user', 'content': prompt})
+        message = {'role': 'user', 'content': prompt}
+        if order == 'prompt-first':
+            messages.insert(0, message)
+        else:
+            messages.append(message)
 
     response = client.responses.create(
         model=model,
@@ -93,9 +268,157 @@ def get_features(client: OpenAI,
     return response
 
 
-def feature_table(response: dict) -> list[dict]:
-    output = (o for o in response['output'] if 'arguments' in o)
-    return [json.loads(o['arguments']) for o in output]
+def with_retries(fn, max_retries: int, **kwargs) -> tuple:
+    """Call fn(**kwargs), retrying up to `max_retries` times with
+    exponential backoff after connection errors, rate limit errors
+    and server errors. Returns a tuple (result, retries).
+
+    """
+
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(**kwargs), attempt
+        except RETRY_ERRORS as err:
+            if attempt == max_retries:
+                raise
+            delay = min(2 ** attempt, 60) * (0.5 + random.random())
+            print(f'{err.__class__.__name__}; retrying in {delay:.1f}s', file=sys.stderr)
+            time.sleep(delay)
+
+
+class RateLimiter:
+    """Spaces calls to acquire() at least 60 / `rpm` seconds apart
+    (no limit if `rpm` is None).
+
+    """
+
+    def __init__(self, rpm: float | None = None):
+        self.interval = 60 / rpm if rpm else 0
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ModelRunner:
+    """Requests features from one model, using cached results when
+    available. Each model has its own rate limit and (optionally)
+    Hedger, since latencies differ among models.
+
+    """
+
+    def __init__(self, client: OpenAI, model: str, tools: list, cache_dir: Path,
+                 validate=None, use_cache: bool = True, max_retries: int = 2,
+                 hedger: Hedger | None = None, rpm: float | None = None,
+                 progress: Progress | None = None, label: str = '',
+                 **kwargs):
+        self.client = client
+        self.model = model
+        self.tools = tools
+        self.cache_dir = cache_dir
+        self.validate = validate
+        self.use_cache = use_cache
+        self.max_retries = max_retries
+        self.hedger = hedger
+        self.limiter = RateLimiter(rpm)
+        self.progress = progress
+        self.label = label
+        self.kwargs = kwargs  # additional arguments for get_features()
+
+    def request(self, **kwargs):
+        self.limiter.acquire()
+        return get_features(**kwargs)
+
+    def message(self, text: str):
+        if self.progress:
+            self.progress.message(text)
+
+    def process(self, infile: Path, content: str,
+                refresh: bool = False) -> tuple[list[dict], dict]:
+        """Returns a tuple (features, record) for input file `infile`
+        with text `content`, where `features` is a list of feature
+        dicts (see check_features()) and `record` contains
+        metrics for the request and a list of validation errors (or
+        the error if the request failed). A cached result is used
+        unless `refresh` is True.
+
+        """
+
+        cache_file = self.cache_dir / f'{infile.stem}-{self.model}.json'
+        if self.use_cache and cache_file.exists() and not refresh:
+            self.message(f'Loading cached results for {infile}{self.label}...')
+            features = json.loads(cache_file.read_text())
+            record = {'cache': 'hit'}
+        else:
+            self.message(f'Processing {infile}{self.label}...')
+            request = partial(self.hedger.call, self.request) if self.hedger else self.request
+            start = time.monotonic()
+            try:
+                response, retries = with_retries(
+                    request,
+                    max_retries=self.max_retries,
+                    client=self.client,
+                    content=content,
+                    tools=self.tools,
+                    model=self.model,
+                    **self.kwargs,
+                )
+            except OpenAIError as err:
+                # recorded as an invalid result (see --retry-invalid)
+                # rather than ending the run
+                errors = [f'request failed ({err.__class__.__name__}: {err})']
+                record = {'cache': 'miss', 'latency': round(time.monotonic() - start, 3),
+                          'filename': infile.name, 'model': self.model,
+                          'valid': False, 'errors': errors}
+                return [], record
+            features = response.to_dict()
+            record = {
+                'cache': 'miss',
+                'latency': round(time.monotonic() - start, 3),
+                'retries': retries,
+                **usage_counts(features),
+            }
+            if self.use_cache:
+                cache_file.write_text(response.to_json())
+
+        table, errors = check_features(features, self.validate)
+        record.update(filename=infile.name, model=self.model, valid=not errors, errors=errors)
+        return table, record
+
+
+def check_features(response: dict, validate=None) -> tuple[list[dict], list[str]]:
+    """Returns a tuple (features, errors), where `features` is a list
+    of the arguments of each tool call in `response` that could be
+    parsed as a json object, and `errors` is a list of problems found,
+    including arguments that are not valid according to `validate`
+    (if provided).
+
+    """
+
+    calls = [o for o in response['output'] if 'arguments' in o]
+    if not calls:
+        return [], ['no tool call in response']
+
+    features, errors = [], []
+    for i, call in enumerate(calls):
+        try:
+            arguments = json.loads(call['arguments'])
+        except json.JSONDecodeError as err:
+            errors.append(f'call {i}: malformed arguments ({err})')
+            continue
+        if validate:
+            errors.extend(f'call {i}: {problem}' for problem in validate(arguments))
+        if isinstance(arguments, dict):
+            features.append(arguments)
+    return features, errors
 
 
 def build_parser(parser):
@@ -106,14 +429,57 @@ def build_parser(parser):
                         help="Optional file with additional prompt content",)
     parser.add_argument('-o', '--outfile', help="Output file",
                         default=sys.stdout, type=argparse.FileType('w'))
-    parser.add_argument('-m', '--model', help="Model name [%(default)s]", default='gpt-5.2')
+    parser.add_argument('--order', choices=['prompt-first', 'document-first'],
+                        default='prompt-first',
+                        help="""Order of the prompt and the document in
+                        each request [%(default)s]""")
+    parser.add_argument('-m', '--model', dest='models', action='append',
+                        help="""Model name; repeat to compare models
+                        [gpt-5.2]""")
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help="Number of concurrent requests per model [%(default)s]")
+    parser.add_argument('--rpm', type=float,
+                        help="Maximum number of requests per minute per model")
+    parser.add_argument('--wide', action='store_true', default=False,
+                        help="""Write one row per file with columns for
+                        the features from each model""")
     parser.add_argument('--cache-dir', default="extract_batch_cache",
                         help="Directory containing cached results [%(default)s]")
     parser.add_argument('-n', '--no-cache', dest='use_cache', action='store_false', default=True)
+    parser.add_argument('--retry-invalid', action='store_true', default=False,
+                        help="""Request features again only for files with
+                        invalid results recorded in the manifest of a
+                        previous run, using cached results for all other
+                        files""")
+    parser.add_argument('--dedup', choices=['exact', 'near'],
+                        help="""Process only one file from each group of
+                        identical ('exact') or nearly identical ('near')
+                        input files""")
+    parser.add_argument('--similarity', type=float, default=0.9,
+                        help="""Minimum estimated Jaccard similarity for
+                        grouping files using --dedup near [%(default)s]""")
+    parser.add_argument('--shard', metavar='K/N', type=parse_shard,
+                        help="""Process only shard K of N of the input
+                        files; requires -o/--outfile""")
+    parser.add_argument('--hedge', metavar='PCT', type=float,
+                        help="""Issue a duplicate request when a request
+                        takes longer than this percentile of observed
+                        latencies (eg, 95)""")
+    parser.add_argument('--hedge-max', metavar='N', type=int,
+                        help="""Maximum number of duplicate requests
+                        per model [10%% of files to be processed]""")
+    parser.add_argument('--max-retries', type=int, default=2,
+                        help="""Maximum number of retries of failed
+                        requests [%(default)s]""")
+    parser.add_argument('--metrics', metavar='FILE',
+                        help="""Write per-file request metrics to FILE
+                        (CSV if FILE ends with .csv, otherwise JSONL)""")
 
 
 def action(args):
 
+    args.models = args.models or ['gpt-5.2']
+
     schema_file = Path(args.schema)
     schema_contents = schema_file.read_text()
     schema_hash = hashlib.md5(schema_contents.encode('utf-8')).hexdigest()
@@ -125,6 +491,18 @@ def action(args):
     if not (args.infile or args.dirname):
         exit('Either -i/--infile or -d/--dirname must be specified')
 
+    if args.shard and args.outfile is sys.stdout:
+        exit('--shard requires -o/--outfile')
+
+    retry = set()
+    if args.retry_invalid:
+        manifest_file = cache_dir / manifest_name(args.shard)
+        if not args.use_cache or not manifest_file.exists():
+            exit(f'--retry-invalid requires cached results and {manifest_file}')
+        previous = json.loads(manifest_file.read_text())
+        retry = {(item['filename'], item['model']) for item in previous.get('invalid', [])}
+        print(f'Retrying {len(retry)} invalid results', file=sys.stderr)
+
     if args.prompt:
         prompt = args.prompt.read()
     else:
@@ -137,34 +515,173 @@ def action(args):
             if p.is_file() and p.suffix.lower() in {'.txt', '.md'}
         )
 
-    client = OpenAI()
+    # retries are performed in with_retries() so that they can be counted
+    client = OpenAI(max_retries=0)
 
     schema = json.loads(schema_contents)
-
-    fieldnames = ['filename', 'model'] + list(schema['parameters']['properties'].keys())
+    validate = compile_schema(schema['parameters'])
+    reserved = OUTPUT_COLUMNS & set(schema['parameters']['properties'])
+    if reserved:
+        exit(f'Schema properties conflict with output columns: {", ".join(sorted(reserved))}')
+
+    files = sorted(files)
+    all_files = files
+    if args.shard:
+        k, n = args.shard
+        files = [f for f in files if shard_of(f, n) == k]
+        print(f'Shard {k}/{n} contains {len(files)} of {len(all_files)} files', file=sys.stderr)
+
+    if args.dedup:
+        # only hashes and signatures are retained while grouping;
+        # representatives are read again when submitted so that the
+        # text of the corpus is never held in memory at once
+        groups = dedup.group_documents(
+            (f.read_text() for f in files), method=args.dedup, threshold=args.similarity)
+        representatives = {files[i]: files[group[0]] for group in groups for i in group}
+        print(f'Grouped {len(files)} files into {len(groups)} groups', file=sys.stderr)
+    else:
+        representatives = {f: f for f in files}
+
+    to_process = sorted(set(representatives.values()))
+
+    # routes requests sharing the schema and prompt to the same cache;
+    # other endpoints may reject the unknown parameter
+    extra = {}
+    if is_openai_endpoint(client):
+        prompt_cache_key = hashlib.md5(
+            (schema_hash + (prompt or '') + args.order).encode('utf-8')).hexdigest()
+        extra['extra_body'] = {'prompt_cache_key': prompt_cache_key}
+
+    progress = Progress(total=len(to_process) * len(args.models))
+    metrics = MetricsWriter(args.metrics) if args.metrics else None
+
+    runners = []
+    for model in args.models:
+        if args.hedge:
+            max_hedges = args.hedge_max
+            if max_hedges is None:
+                max_hedges = math.ceil(0.1 * len(to_process))
+            hedger = Hedger(percentile=args.hedge, max_hedges=max_hedges)
+        else:
+            hedger = None
+        runners.append(ModelRunner(
+            client=client,
+            model=model,
+            tools=[schema],
+            cache_dir=cache_dir,
+            validate=validate,
+            use_cache=args.use_cache,
+            max_retries=args.max_retries,
+            hedger=hedger,
+            rpm=args.rpm,
+            progress=progress,
+            label=f' ({model})' if len(args.models) > 1 else '',
+            prompt=prompt,
+            order=args.order,
+            **extra,
+        ))
+
+    # each file is read once and submitted for all models; the number
+    # of pending requests is limited so that file contents are not all
+    # held in memory
+    executors = [ThreadPoolExecutor(max_workers=args.workers) for _ in runners]
+    max_pending = max(4 * args.workers * len(runners), 64)
+    results = {}
+    invalid = []
+    pending = set()
+
+    def collect(futures):
+        for future in futures:
+            infile, model = future.key
+            features, record = future.result()
+            results[(infile, model)] = features, record['errors']
+            if record['errors']:
+                invalid.append({'filename': infile.name, 'model': model,
+                                'errors': record['errors']})
+            progress.update(record)
+            if metrics:
+                metrics.write(record)
+
+    try:
+        for infile in to_process:
+            content = infile.read_text()
+            for runner, executor in zip(runners, executors):
+                refresh = (infile.name, runner.model) in retry
+                future = executor.submit(runner.process, infile, content, refresh)
+                future.key = (infile, runner.model)
+                pending.add(future)
+            while len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        done, pending = wait(pending)
+        collect(done)
+    finally:
+        for executor in executors:
+            executor.shutdown(cancel_futures=True)
+        if metrics:
+            metrics.close()
+
+    feature_names = list(schema['parameters']['properties'].keys())
+    fieldnames = ['filename'] + (['representative'] if args.dedup else [])
+    if args.wide:
+        fieldnames += [f'{model}.{name}' for model in args.models
+                       for name in feature_names + ['errors']]
+    else:
+        fieldnames += ['model'] + feature_names + ['errors']
     writer = csv.DictWriter(args.outfile, fieldnames=fieldnames, extrasaction='ignore')
     writer.writeheader()
 
-    for infile in sorted(files):
-        cache_file = cache_dir / f'{infile.stem}-{args.model}.json'
-        if args.use_cache and cache_file.exists():
-            print(f'Loading cached results for {infile}...', file=sys.stderr)
-            features = json.loads(cache_file.read_text())
+    for infile in files:
+        representative = representatives[infile]
+        tables, errors = [], []
+        for model in args.models:
+            table, errs = results[(representative, model)]
+            # files with errors and no features are represented by a blank row
+            tables.append(table or ([{}] if errs else []))
+            errors.append('; '.join(errs))
+        if args.wide:
+            # the i-th row of features from each model are combined
+            for i in range(max(len(table) for table in tables)):
+                # ensure all fields present
+                tab = {f'{model}.{k}': '' for model in args.models for k in feature_names}
+                tab.update(filename=infile.name, representative=representative.name)
+                for model, table, errs in zip(args.models, tables, errors):
+                    if i < len(table):
+                        tab.update({f'{model}.{k}': v for k, v in table[i].items()})
+                        tab[f'{model}.errors'] = errs
+                writer.writerow(tab)
         else:
-            print(f'Processing {infile}...', file=sys.stderr)
-            response = get_features(
-                client=client,
-                content=infile.read_text(),
-                tools=[schema],
-                model=args.model,
-                prompt=prompt,
-            )
-            features = response.to_dict()
-            if args.use_cache:
-                cache_file.write_text(response.to_json())
-
-        for i, feature in enumerate(feature_table(features), 1):
-            tab = {'filename': infile.name, 'model': args.model}
-            tab.update({k: '' for k in fieldnames[2:]})  # ensure all fields present
-            tab.update(feature)
-            writer.writerow(tab)
+            for model, table, errs in zip(args.models, tables, errors):
+                for feature in table:
+                    tab = {'filename': infile.name, 'model': model,
+                           'representative': representative.name}
+                    tab.update({k: '' for k in feature_names})  # ensure all fields present
+                    tab.update(feature)
+                    tab['errors'] = errs
+                    writer.writerow(tab)
+
+    progress.finish()
+    for runner in runners:
+        if runner.hedger:
+            print(f'Hedging{runner.label}: {runner.hedger.summary()}', file=sys.stderr)
+
+    k, n = args.shard or (1, 1)
+    manifest = {
+        'shard': k,
+        'nshards': n,
+        'schema': schema_file.name,
+        'schema_hash': schema_hash,
+        'models': args.models,
+        'wide': args.wide,
+        'ninputs': len(all_files),
+        'inputs_digest': inputs_digest(all_files),
+        'outfile': args.outfile.name,
+        'files': {f.name: {'representative': representatives[f].name} for f in files},
+        'invalid': sorted(invalid, key=lambda item: (item['filename'], item['model'])),
+    }
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    manifest_file = cache_dir / manifest_name(args.shard)
+    manifest_file.write_text(json.dumps(manifest, indent=2))
+    if invalid:
+        print(f'{len(invalid)} invalid results are listed in {manifest_file}; '
+              'use --retry-invalid to request them again', file=sys.stderr)
@@ -0,0 +1,122 @@
+"""Merge the output of sharded extract_batch runs.
+
+Each run of ``extract_batch --shard K/N`` writes an output file and a
+manifest (``manifest-K-of-N.json`` in the cache directory). Given the
+manifests for all shards, combine the output files into a single table
+ordered by file name, verifying that every shard is present, that all
+shards were produced from the same input files, schema and models, and
+that every input file was assigned to exactly one shard::
+
+  dawgtools extract_merge manifest-*-of-4.json -o features.csv
+
+The output file of each shard is found using the path recorded in the
+manifest, or if that does not exist, a file with the same name in the
+directory containing the manifest.
+
+"""
+
+import argparse
+import csv
+import heapq
+import json
+import sys
+from pathlib import Path
+
+
+class MergeError(Exception):
+    pass
+
+
+def load_manifests(paths: list[Path]) -> list[dict]:
+    """Read the manifests and verify that they describe a complete
+    set of shards. Returns the manifests ordered by shard.
+
+    """
+
+    manifests = []
+    for path in paths:
+        manifest = json.loads(path.read_text())
+        manifest['path'] = path
+        manifests.append(manifest)
+
+    for key in ['nshards', 'inputs_digest', 'schema_hash', 'models', 'wide']:
+        values = {json.dumps(m.get(key)) for m in manifests}
+        if len(values) > 1:
+            raise MergeError(f'manifests have inconsistent values for {key}: {sorted(values)}')
+
+    manifests.sort(key=lambda m: m['shard'])
+    nshards = manifests[0]['nshards']
+    shards = [m['shard'] for m in manifests]
+    if shards != list(range(1, nshards + 1)):
+        missing = sorted(set(range(1, nshards + 1)) - set(shards))
+        raise MergeError(f'expected shards 1-{nshards}; missing: {missing}; provided: {shards}')
+
+    nfiles = sum(len(m['files']) for m in manifests)
+    if len(set().union(*(m['files'] for m in manifests))) != nfiles:
+        raise MergeError('some input files are listed in the manifests of more than one shard')
+    if nfiles != manifests[0]['ninputs']:
+        raise MergeError(f'shards contain {nfiles} of {manifests[0]["ninputs"]} input files')
+
+    return manifests
+
+
+def find_outfile(manifest: dict) -> Path:
+    outfile = Path(manifest['outfile'])
+    if outfile.exists():
+        return outfile
+    local = manifest['path'].parent / outfile.name
+    if local.exists():
+        return local
+    raise MergeError(f'output file {outfile} for shard {manifest["shard"]} not found')
+
+
+def read_shard(manifest: dict, fieldnames: list | None):
+    """Returns a tuple (fieldnames, rows) from the output file for a
+    shard after verifying that the header matches `fieldnames` (if
+    provided) and that each row describes a file in the manifest (a
+    file may have no rows if the model returned no results). Rows are
+    sorted by file name, retaining the original order of rows for each
+    file.
+
+    """
+
+    outfile = find_outfile(manifest)
+    with open(outfile, newline='') as f:
+        reader = csv.DictReader(f)
+        if fieldnames and reader.fieldnames != fieldnames:
+            raise MergeError(f'{outfile} has fields {reader.fieldnames}; expected {fieldnames}')
+        rows = sorted(reader, key=lambda row: row['filename'])
+
+    unexpected = {row['filename'] for row in rows} - set(manifest['files'])
+    if unexpected:
+        raise MergeError(f'{outfile} contains results for {len(unexpected)} files not in '
+                         f'the manifest for shard {manifest["shard"]}, '
+                         f'including {sorted(unexpected)[0]}')
+    return reader.fieldnames, rows
+
+
+def build_parser(parser):
+    parser.add_argument('manifests', nargs='+', type=Path,
+                        help="Manifest files for each shard")
+    parser.add_argument('-o', '--outfile', help="Output file",
+                        default=sys.stdout, type=argparse.FileType('w'))
+
+
+def action(args):
+
+    try:
+        manifests = load_manifests(args.manifests)
+        fieldnames = None
+        shards = []
+        for manifest in manifests:
+            fieldnames, rows = read_shard(manifest, fieldnames)
+            shards.append(rows)
+    except MergeError as err:
+        exit(f'Error: {err}')
+
+    writer = csv.DictWriter(args.outfile, fieldnames=fieldnames)
+    writer.writeheader()
+    writer.writerows(heapq.merge(*shards, key=lambda row: row['filename']))
+
+    print(f'Merged {len(manifests)} shards containing {manifests[0]["ninputs"]} files',
+          file=sys.stderr)
@@ -23,6 +23,82 @@ containing mrns that can be referenced in the query. For example:
   {"mrn": "fie"}
   {"mrn": "fo"}
   {"mrn": "fum"}
+
+Queries packaged with dawgtools are selected using -n/--query-name.
+Their parameters are declared in the query file (see
+dawgtools.registry), so missing or invalid parameters are reported
+before connecting to the database; packaged queries may also specify
+the number of rows retrieved at a time and the default output format.
+
+By default, only the first result set returned by the query is
+written. A query may return several result sets over one connection
+(for example, several select statements sharing a temporary table);
+use --all-sets to write each result set to its own file, identified by
+'{resultset}' in the output file name. Result sets are numbered
+starting with 1, or may be named using a comment of the form
+'-- resultset: name' preceding each select statement (if any result set
+is named, all must be, and names must be unique):
+
+  $ cat counts.sql
+  -- resultset: patients
+  select count(*) as n from #mrns;
+  -- resultset: mrns
+  select mrn from #mrns;
+  $ dawgtools query --mrns mrns.txt -i counts.sql --all-sets -o 'out-{resultset}.csv' -f csv
+  $ ls out-*
+  out-mrns.csv  out-patients.csv
+
+Use --timeout to cancel a query that has not completed within a number
+of seconds. When a query is cancelled by the timeout or interrupted
+(eg, using ctrl-c), the rows retrieved so far are written to the output
+file along with a marker file with the suffix '.partial.json'
+describing the reason and the number of rows written:
+
+  $ dawgtools query -i slow.sql -o out.csv -f csv --timeout 600
+  $ cat out.csv.partial.json
+  {"partial": true, "reason": "timeout", "resultset": "1", "rows": 182000}
+
+Use --limit and --sample to retrieve a subset of the rows while
+developing a query. --limit N adds 'top (N)' to a query consisting of
+a single select statement. Otherwise (eg, for several statements or a
+'begin ... end' block), the server stops each statement after N rows
+(SET ROWCOUNT), which also truncates intermediate statements such as
+insert, update, delete or select into. --sample PCT retains a
+deterministic sample of approximately PCT percent of the rows of a
+temporary table (--mrns or --temp-data) on the server before running
+the query, selected using a hash of --sample-key (by default, the
+first column of the index or the table), so that repeated runs return
+the same subset of the cohort:
+
+  $ cat cohort_notes.sql
+  select pat.PAT_MRN_ID as mrn, info.NOTE_ID, info.CREATE_INSTANT_DTTM
+  from #mrns
+  join uwDAL_Clarity.dbo.PATIENT pat on pat.PAT_MRN_ID = #mrns.mrn
+  join uwDAL.clarity.HNO_INFO info on info.PAT_ID = pat.PAT_ID
+  where info.CREATE_INSTANT_DTTM >= %(min_date)s
+  $ dawgtools query -i cohort_notes.sql -p min_date=2024-01-01 --mrns mrns.txt --sample 1 --limit 500
+
+Without a temporary table, --sample filters the rows of the query
+itself using a hash of the column --sample-key; this requires a single
+select statement without a common table expression or 'order by'.
+
+Use --server-stats to collect statistics reported by the server for
+each statement (SET STATISTICS IO, TIME): logical and physical reads
+per table, and CPU and elapsed times. Statistics are written in json
+format to a file with the suffix '.stats.json' (or to stderr if the
+output is written to stdout). --explain additionally captures the
+actual execution plan of each statement (SET STATISTICS XML), written
+to files with the suffix '.<n>.sqlplan' that can be opened using SQL
+Server Management Studio:
+
+  $ dawgtools query -n path_reports --mrns mrns.txt -o out.csv -f csv --explain
+  $ ls out.csv.*
+  out.csv.1.sqlplan  out.csv.2.sqlplan  out.csv.stats.json
+
+Queries may be executed by a daemon holding open database connections
+(see 'dawgtools serve') using --daemon. Temporary tables are loaded by
+the daemon, and with --session are kept for subsequent queries in the
+same session.
 """
 
 import argparse
@@ -30,11 +106,12 @@ import csv
 import gzip
 import json
 import logging
+import os
 import sys
 from functools import partial
 
-from dawgtools import db
-from dawgtools.utils import MyJSONEncoder, StdOut
+from dawgtools import db, daemon, registry
+from dawgtools.utils import MyJSONEncoder, StdOut, iter_json_array, iter_json_rows
 
 log = logging.getLogger(__name__)
 
@@ -58,7 +135,7 @@ def build_parser(parser):
     inputs.add_argument('-i', '--infile', type=argparse.FileType('r'),
                         help="Input file containing an sql command")
     inputs.add_argument('-n', '--query-name', choices=db.list_queries(),
-                        help="name of an sql query")
+                        help="name of a packaged sql query")
     inputs.add_argument('-p', '--params', nargs='*',
                         help="""One or more variable value pairs in
                         the form -p var=val; these are used as
@@ -71,7 +148,8 @@ def build_parser(parser):
                            help="""A file containing
                            whitespace-delimited mrns to be loaded into
                            a temporary table '#mrns(mrn varchar(102))'
-                           before the query.""")
+                           with a clustered index on mrn before the
+                           query. Duplicate mrns are removed.""")
     temptable.add_argument('--temp-schema', metavar='FILE', type=argparse.FileType('r'),
                            help="""File containing schema for a
                            temporary table to be created before
@@ -81,20 +159,124 @@ def build_parser(parser):
                            to the schema containing data to load into
                            the temporary table before running the
                            query. Requires --temp-schema. Columns not
-                           in the schema are ignored.""")
+                           in the schema are ignored, and duplicate rows
+                           are removed.""")
+    temptable.add_argument('--temp-index', metavar='COLUMNS',
+                           help="""Comma-delimited list of columns of the
+                           table defined by --temp-schema on which to
+                           create a clustered index after loading.""")
 
     outputs = parser.add_argument_group('outputs')
     outputs.add_argument('-o', '--outfile',
                          help="""Output file name; uses gzip compression
                          if ends with .gz or stdout if not provided.""")
-    outputs.add_argument('-f', '--format', default='jsonl',
+    outputs.add_argument('-f', '--format',
                          choices=['jsonl', 'json', 'json-rows', 'csv'],
-                         help='Output format [%(default)s]')
+                         help="""Output format [the default for the
+                         packaged query, or jsonl]""")
+    outputs.add_argument('--compact', action='store_true', default=False,
+                         help="""Omit indentation and whitespace from json
+                         and json-rows output""")
+    outputs.add_argument('--all-sets', action='store_true', default=False,
+                         help="""Write all result sets returned by the
+                         query; the output file name must contain
+                         '{resultset}', which is replaced with the name
+                         or number of each result set.""")
+
+    subset = parser.add_argument_group('subset')
+    subset.add_argument('--limit', metavar='N', type=int,
+                        help="""Return at most N rows; for a query
+                        other than a single select statement, each
+                        statement (including insert, update, delete or
+                        select into) stops after N rows""")
+    subset.add_argument('--sample', metavar='PCT', type=float,
+                        help="""Retain a deterministic sample of about
+                        PCT percent of the temporary table, or if there
+                        is none, of the rows of the query""")
+    subset.add_argument('--sample-key', metavar='COLUMN',
+                        help="""Column used to select the sample
+                        (required for a query without a temporary
+                        table)""")
 
+    stats = parser.add_argument_group('statistics')
+    stats.add_argument('--server-stats', action='store_true', default=False,
+                       help="""Write reads per table and CPU and elapsed
+                       times reported by the server to
+                       '<outfile>.stats.json' (or stderr)""")
+    stats.add_argument('--explain', action='store_true', default=False,
+                       help="""Implies --server-stats, and writes the
+                       actual execution plan of each statement to
+                       '<outfile>.<n>.sqlplan'""")
+
+    server = parser.add_argument_group('daemon')
+    server.add_argument('--daemon', metavar='SOCKET', nargs='?', const=daemon.DEFAULT_SOCKET,
+                        help="""Execute the query using the daemon
+                        started by 'dawgtools serve' listening on SOCKET
+                        [%(const)s]""")
+    server.add_argument('--session', metavar='NAME',
+                        help="""With --daemon, execute the query in a
+                        named session in which temporary tables are
+                        retained between queries""")
+
+    parser.add_argument('--fetch-size', metavar='N', type=int,
+                        help=f"""Number of rows to retrieve from the server
+                        at a time [the default for the packaged query, or
+                        {db.FETCH_SIZE}]""")
+    parser.add_argument('--timeout', metavar='SECONDS', type=float,
+                        help="""Cancel the query if it has not completed
+                        within SECONDS (not including loading a temporary
+                        table); rows retrieved before the query is
+                        cancelled are written to the output""")
     parser.add_argument('-x', '--dry-run', action='store_true', default=False,
                         help='Print the rendered query and exit')
 
 
+def write_rows(f, fmt: str, headers: list, rows, compact: bool = False):
+    """Write `rows` to file object `f` in format `fmt`. Rows are
+    written as they are consumed from the iterator `rows`.
+
+    """
+
+    indent = None if compact else 2
+    if fmt == 'jsonl':
+        for row in rows:
+            f.write(json.dumps(dict(zip(headers, row)), cls=MyJSONEncoder) + '\n')
+    elif fmt == 'json':
+        f.writelines(iter_json_array((dict(zip(headers, row)) for row in rows), indent=indent))
+    elif fmt == 'json-rows':
+        f.writelines(iter_json_rows(headers, rows, indent=indent))
+    elif fmt == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        writer.writerows(rows)
+
+
+def write_stats(stats: db.ServerStats, outfile: str | None):
+    """Write server statistics to '{outfile}.stats.json' and each
+    execution plan to '{outfile}.{n}.sqlplan', or statistics only to
+    stderr if `outfile` is None.
+
+    """
+
+    summary = stats.to_dict()
+    if outfile is None:
+        if stats.plans:
+            log.warning('execution plans are not written when output is written to stdout')
+        json.dump(summary, sys.stderr, indent=2)
+        sys.stderr.write('\n')
+        return
+
+    summary['plans'] = []
+    for n, plan in enumerate(stats.plans, 1):
+        planfile = f'{outfile}.{n}.sqlplan'
+        with open(planfile, 'w', encoding='utf-8') as f:
+            f.write(plan)
+        summary['plans'].append(planfile)
+
+    with open(outfile + '.stats.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+
+
 def action(args):
 
     if args.params:
@@ -102,58 +284,113 @@ def action(args):
     else:
         params = {}
 
+    fmt, fetch_size = args.format, args.fetch_size
     if args.query:
         query = args.query
     elif args.infile:
         query = args.infile.read()
     elif args.query_name:
-        query = db.get_query(args.query_name)
+        spec = registry.get(args.query_name)
+        query = spec.sql
+        params = spec.validate(params)
+        fmt = fmt or spec.format
+        fetch_size = fetch_size or spec.fetch_size
     else:
         raise ValueError("Must provide either a query, input file, or query name")
+    fmt = fmt or 'jsonl'
+    fetch_size = fetch_size or db.FETCH_SIZE
 
-    if args.dry_run:
-        sql, params = db.render_template(query, params)
-        print(sql)
-        print(f"Parameters: {params}")
-        return
-
+    temp_table = None
     if args.temp_schema and args.temp_data:
-        callback = partial(
-            db.create_and_load_temp_table,
+        temp_table = dict(
             sql_cmd=args.temp_schema.read(),
-            rows=list(csv.DictReader(args.temp_data))
+            rows=list(csv.DictReader(args.temp_data)),
+            index=args.temp_index.split(',') if args.temp_index else None,
         )
     elif args.mrns:
-        callback = partial(
-            db.create_and_load_temp_table,
+        temp_table = dict(
             sql_cmd='drop table if exists #mrns; create table #mrns (mrn varchar(102));',
-            rows=[{'mrn': mrn} for mrn in args.mrns.read().split()]
+            rows=[{'mrn': mrn} for mrn in args.mrns.read().split()],
+            index=['mrn'],
         )
 
-    headers, rows = db.sql_query(query, params, callback=callback)
-
-    if args.outfile:
-        outfile = args.outfile.format(**params)
-        if outfile.endswith('.gz'):
-            opener = gzip.open
+    if args.sample is not None:
+        if temp_table:
+            temp_table.update(sample=args.sample, sample_key=args.sample_key)
+        elif args.sample_key:
+            query = db.sample_query(query, args.sample_key, args.sample)
         else:
-            opener = open
+            raise ValueError('--sample requires --sample-key for a query without a temporary table')
+
+    if args.dry_run:
+        sql, params = db.render_template(query, params)
+        print(sql)
+        print(f"Parameters: {params}")
+        return
+
+    if args.all_sets and '{resultset}' not in (args.outfile or ''):
+        raise ValueError("--all-sets requires an output file name containing '{resultset}'")
+
+    stats = None
+    if args.server_stats or args.explain:
+        if args.daemon:
+            raise ValueError('--server-stats and --explain are not supported with --daemon')
+        stats = db.ServerStats(plans=args.explain)
+
+    if args.daemon:
+        result_sets = daemon.iter_result_sets(
+            args.daemon, query, params,
+            temp_tables=[temp_table] if temp_table else None,
+            session=args.session,
+            fetch_size=fetch_size,
+            timeout=args.timeout,
+            limit=args.limit)
     else:
-        outfile = None
-        opener = StdOut
-
-    with opener(outfile, 'wt', encoding='utf-8', errors='ignore') as f:
-        if args.format == 'jsonl':
-            for row in db.as_dicts(headers, rows):
-                f.write(json.dumps(row, cls=MyJSONEncoder) + '\n')
-        elif args.format == 'json':
-            f.write(json.dumps(db.as_dicts(headers, rows), indent=2, cls=MyJSONEncoder))
-        elif args.format == 'json-rows':
-            f.write(json.dumps(dict(
-                fieldnames=headers,
-                data=[list(row) for row in rows],
-            ), indent=2, cls=MyJSONEncoder))
-        elif args.format == 'csv':
-            writer = csv.writer(f)
-            writer.writerow(headers)
-            writer.writerows(rows)
+        callback = partial(db.create_and_load_temp_table, **temp_table) if temp_table else None
+        result_sets = db.iter_result_sets(query, params, callback=callback,
+                                          fetch_size=fetch_size,
+                                          timeout=args.timeout, stats=stats,
+                                          limit=args.limit)
+
+    def counted(rows):
+        nonlocal nrows
+        for nrows, row in enumerate(rows, 1):
+            yield row
+
+    name, outfile, nrows = None, None, 0
+    try:
+        for name, headers, rows in result_sets:
+            nrows = 0
+            if args.outfile:
+                outfile = args.outfile.format(resultset=name, **params)
+                if outfile.endswith('.gz'):
+                    opener = gzip.open
+                else:
+                    opener = open
+                if os.path.exists(outfile + '.partial.json'):
+                    os.remove(outfile + '.partial.json')
+            else:
+                outfile = None
+                opener = StdOut
+
+            with opener(outfile, 'wt', encoding='utf-8', errors='ignore') as f:
+                write_rows(f, fmt, headers, counted(rows), compact=args.compact)
+
+            if not args.all_sets:
+                if stats:
+                    # statistics and plans for the remaining statements
+                    # are returned after the first result set
+                    for _, _, rows in result_sets:
+                        for _ in rows:
+                            pass
+                break
+    except (db.QueryCancelled, KeyboardInterrupt) as err:
+        reason = getattr(err, 'reason', 'SIGINT')
+        log.error(f'Query cancelled ({reason}) after writing {nrows} rows; output is incomplete')
+        if outfile:
+            with open(outfile + '.partial.json', 'w') as f:
+                json.dump({'partial': True, 'reason': reason, 'resultset': name, 'rows': nrows}, f)
+        return 1
+    finally:
+        if stats:
+            write_stats(stats, args.outfile and args.outfile.format(resultset='all', **params))
@@ -0,0 +1,36 @@
+"""Serve queries from a local daemon with warm database connections.
+
+Each invocation of ``dawgtools query`` starts python, imports
+dependencies, connects to the database, and loads any temporary tables
+before running the query. The daemon started by this command holds
+open connections between queries; ``dawgtools query --daemon``
+forwards the rendered query to the daemon and streams back the rows.
+
+Queries providing a session name using ``--session`` run on a
+connection dedicated to that session, so that a temporary table (for
+example, ``--mrns``) is loaded once and reused by later queries in the
+same session with the same contents:
+
+  $ dawgtools serve &
+  $ dawgtools query --daemon --session cohort --mrns mrns.txt -n notes ...
+  $ dawgtools query --daemon --session cohort --mrns mrns.txt -i labs.sql ...
+
+The daemon listens on a Unix socket that is accessible only to the
+user running it, and runs queries using that user's credentials.
+"""
+
+from dawgtools import daemon
+
+
+def build_parser(parser):
+    parser.add_argument('-s', '--socket', default=daemon.DEFAULT_SOCKET,
+                        help="Path to the socket [%(default)s]")
+
+
+def action(args):
+    try:
+        daemon.serve(args.socket)
+    except daemon.DaemonError as err:
+        exit(f'Error: {err}')
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,329 @@
+"""A local server that executes queries using warm database connections.
+
+The server listens on a Unix socket and keeps database connections open
+between queries. Queries without a session name use a pool of
+connections. Queries with a session name always use the same
+connection, so temporary tables created in that session remain
+available; a temporary table is loaded only if its definition or
+contents differ from the table already loaded in the session.
+
+Messages are JSON objects, one per line. A request contains the
+rendered query and its positional parameters::
+
+  {"sql": "...", "params": [...], "names": [...], "session": "cohort1",
+   "temp_tables": [{"sql_cmd": "...", "rows": [...], "index": [...]}],
+   "fetch_size": 5000, "timeout": 600, "limit": 100}
+
+The server applies "limit" using SET ROWCOUNT; the client instead adds
+'top (N)' to a query consisting of a single select statement (see
+db.limit_query()) and omits the limit.
+
+The response is a sequence of messages for each result set, ending
+with a message indicating either success or an error::
+
+  {"resultset": "1", "headers": [...]}
+  {"rows": [[...], ...]}
+  {"done": true}
+
+Values that cannot be represented in JSON (datetimes, dates, times,
+decimals and bytes) are tagged so that they can be restored by the
+client.
+
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from datetime import date, datetime, time
+from decimal import Decimal
+from pathlib import Path
+
+from dawgtools import db
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = str(Path.home() / '.dawgtools.sock')
+
+
+class DaemonError(Exception):
+    pass
+
+
+def encode_value(obj):
+    if isinstance(obj, datetime):
+        return {'$datetime': obj.isoformat()}
+    elif isinstance(obj, date):
+        return {'$date': obj.isoformat()}
+    elif isinstance(obj, time):
+        return {'$time': obj.isoformat()}
+    elif isinstance(obj, Decimal):
+        return {'$decimal': str(obj)}
+    elif isinstance(obj, (bytes, bytearray)):
+        return {'$bytes': base64.b64encode(obj).decode('ascii')}
+    raise TypeError(f'Object of type {obj.__class__.__name__} is not JSON serializable')
+
+
+DECODERS = {
+    '$datetime': datetime.fromisoformat,
+    '$date': date.fromisoformat,
+    '$time': time.fromisoformat,
+    '$decimal': Decimal,
+    '$bytes': base64.b64decode,
+}
+
+
+def decode_value(obj: dict):
+    if len(obj) == 1:
+        key, value = next(iter(obj.items()))
+        if key in DECODERS:
+            return DECODERS[key](value)
+    return obj
+
+
+def dumps(message: dict) -> bytes:
+    return (json.dumps(message, default=encode_value) + '\n').encode('utf-8')
+
+
+def loads(line: bytes) -> dict:
+    return json.loads(line, object_hook=decode_value)
+
+
+class Session:
+    """A connection and the digests of the temporary tables loaded
+    using it.
+
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.temp_tables = {}
+
+    def load_temp_table(self, cursor, sql_cmd: str, rows: list, index: list | None = None,
+                        **kwargs):
+        tablename = db.temp_table_name(sql_cmd)
+        digest = hashlib.md5(json.dumps([sql_cmd, rows, index, kwargs], sort_keys=True,
+                                        default=str).encode('utf-8')).hexdigest()
+        if self.temp_tables.get(tablename) == digest:
+            log.info(f'using previously loaded table {tablename}')
+            return
+        # the table may remain on the connection from a previous
+        # request even if it is no longer tracked (see SessionPool.release())
+        cursor.execute(f'drop table if exists {tablename}')
+        db.create_and_load_temp_table(cursor, sql_cmd=sql_cmd, rows=rows, index=index, **kwargs)
+        self.temp_tables[tablename] = digest
+
+
+class SessionPool:
+    """Provides named sessions, and unnamed sessions from a pool of
+    idle connections.
+
+    """
+
+    def __init__(self, connect):
+        self.connect = connect
+        self.lock = threading.Lock()
+        self.named = {}
+        self.idle = []
+
+    def acquire(self, name: str | None = None) -> Session:
+        with self.lock:
+            if name is None:
+                session = self.idle.pop() if self.idle else None
+            else:
+                session = self.named.get(name)
+        if session is None:
+            session = Session(self.connect())
+            if name is not None:
+                with self.lock:
+                    session = self.named.setdefault(name, session)
+        session.lock.acquire()
+        return session
+
+    def release(self, session: Session, name: str | None = None):
+        session.lock.release()
+        if name is None:
+            # temporary tables in unnamed sessions are not reused; they
+            # are dropped before a table with the same name is loaded
+            session.temp_tables.clear()
+            with self.lock:
+                self.idle.append(session)
+
+    def discard(self, session: Session, name: str | None = None):
+        session.lock.release()
+        with self.lock:
+            if name is not None and self.named.get(name) is session:
+                del self.named[name]
+        try:
+            session.conn.close()
+        except Exception:
+            pass
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # a connection without a request (see Server.__init__())
+            return
+        request = loads(line)
+        name = request.get('session')
+        fetch_size = request.get('fetch_size') or db.FETCH_SIZE
+        limit = request.get('limit')
+        pool = self.server.pool
+        session = pool.acquire(name)
+        cursor = None
+        watchdog = None
+        try:
+            cursor = session.conn.cursor()
+            for temp_table in request.get('temp_tables') or []:
+                session.load_temp_table(cursor, **temp_table)
+            with db.Watchdog(cursor, timeout=request.get('timeout'), signals=()) as watchdog:
+                if limit:
+                    cursor.execute(f'set rowcount {int(limit)}')
+                cursor.execute(request['sql'], request.get('params') or [])
+                result_sets = db.cursor_result_sets(cursor, request.get('names'), fetch_size)
+                for resultset, headers, rows in result_sets:
+                    self.wfile.write(dumps({'resultset': resultset, 'headers': headers}))
+                    chunk = []
+                    for row in db.guard_rows(rows, watchdog):
+                        chunk.append(list(row))
+                        if len(chunk) == fetch_size:
+                            self.wfile.write(dumps({'rows': chunk}))
+                            chunk = []
+                    if chunk:
+                        self.wfile.write(dumps({'rows': chunk}))
+            if limit:
+                cursor.execute('set rowcount 0')
+            session.conn.commit()
+            self.wfile.write(dumps({'done': True}))
+        except Exception as err:
+            # includes errors writing to a client that went away
+            message = f'{err.__class__.__name__}: {err}'
+            log.error(message)
+            if watchdog and watchdog.reason:
+                err = db.QueryCancelled(watchdog.reason)
+            try:
+                if cursor:
+                    cursor.cancel()
+                    if limit:
+                        # the row count applies to the connection
+                        cursor.execute('set rowcount 0')
+                session.conn.rollback()
+            except Exception:
+                pool.discard(session, name)
+            else:
+                pool.release(session, name)
+            try:
+                self.wfile.write(dumps({'error': message,
+                                        'cancelled': getattr(err, 'reason', None)}))
+            except OSError:
+                pass
+        else:
+            pool.release(session, name)
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, connect=None):
+        self.pool = SessionPool(connect or (lambda: db.pyodbc.connect(db.CONNECTION_STRING)))
+        if os.path.exists(socket_path):
+            # the socket is removed only if no server is listening on it
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(socket_path)
+                except OSError:
+                    os.remove(socket_path)
+                else:
+                    raise DaemonError(f'a server is already listening on {socket_path}')
+        # the server runs queries using the credentials of its owner,
+        # so only the owner may connect
+        umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, Handler)
+        finally:
+            os.umask(umask)
+
+
+def serve(socket_path: str = DEFAULT_SOCKET, connect=None):
+    """Serve queries on `socket_path` until interrupted"""
+    with Server(socket_path, connect=connect) as server:
+        log.warning(f'listening on {socket_path}')
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+def iter_result_sets(socket_path: str,
+                     query: str,
+                     params: dict | None = None,
+                     temp_tables: list[dict] | None = None,
+                     session: str | None = None,
+                     fetch_size: int = db.FETCH_SIZE,
+                     timeout: float | None = None,
+                     limit: int | None = None):
+    """Executes a query using the server listening on `socket_path`.
+    The query is rendered as described for db.sql_query(), and
+    `temp_tables` is a list of dicts with keys 'sql_cmd', 'rows' and
+    (optionally) 'index', 'sample' and 'sample_key' as expected by
+    db.create_and_load_temp_table(). Yields tuples (name, headers,
+    rows) as described for db.iter_result_sets(). The query is
+    cancelled by the server if it has not completed within `timeout`
+    seconds, in which case db.QueryCancelled is raised. Rows are
+    limited to `limit` as described for db.iter_result_sets().
+
+    """
+
+    sql, bind_params = db.render_template(query, params or {})
+    names = db.result_set_names(sql)
+    if limit and (limited := db.limit_query(sql, limit)):
+        sql, limit = limited, None
+    elif limit:
+        log.warning(f'limiting each statement to {limit} rows using SET ROWCOUNT')
+    request = {
+        'sql': sql,
+        'params': bind_params,
+        'names': names,
+        'session': session,
+        'temp_tables': temp_tables,
+        'fetch_size': fetch_size,
+        'timeout': timeout,
+        'limit': limit,
+    }
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(dumps(request))
+        with sock.makefile('rb') as f:
+            messages = (loads(line) for line in f)
+            message = next(messages, {'error': 'no response from server'})
+            while True:
+                if message.get('cancelled'):
+                    raise db.QueryCancelled(message['cancelled'])
+                elif 'error' in message:
+                    raise DaemonError(message['error'])
+                elif message.get('done'):
+                    return
+
+                # iterates over rows until the start of the next result
+                # set or the end of the response is reached
+                def rows():
+                    nonlocal message
+                    for message in messages:
+                        if 'rows' not in message:
+                            return
+                        yield from message['rows']
+                    message = {'error': 'incomplete response from server'}
+
+                rowiter = rows()
+                yield message['resultset'], message['headers'], rowiter
+                for _ in rowiter:
+                    pass
@@ -1,9 +1,15 @@
 import json
 import logging
+import math
 import re
+import select
+import signal
+import socket
+import threading
+import time
 from operator import itemgetter
-from pathlib import Path
 from types import FunctionType
+from typing import Iterator, TYPE_CHECKING
 
 try:
     import pyodbc
@@ -12,6 +18,12 @@ except ImportError:
 
 from jinja2 import Template
 
+from dawgtools import registry
+
+if TYPE_CHECKING:
+    # imported in query_columns() so that numpy is loaded only when needed
+    from dawgtools import columnar
+
 log = logging.getLogger(__name__)
 
 if not pyodbc:
@@ -23,16 +35,171 @@ CONNECTION_STRING = ';'.join([
     'Trusted_Connection=yes'
 ])
 
+# number of rows retrieved from the server at a time when streaming results
+FETCH_SIZE = 5000
+
+
+class QueryCancelled(Exception):
+    """Raised when a query is cancelled because its deadline passed
+    ('timeout') or the process received a signal (eg, 'SIGINT').
+
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(f'query cancelled ({reason})')
+        self.reason = reason
+
+
+class Watchdog:
+    """Context manager that cancels the statement running on `cursor`
+    from a background thread when `timeout` seconds have elapsed or,
+    when used in the main thread, when one of `signals` is received.
+
+    Python signal handlers run only when the main thread returns from
+    a blocking call, so signals are delivered to the watchdog thread
+    using signal.set_wakeup_fd(); the statement is cancelled while
+    the main thread is still waiting on the server.
+
+    """
+
+    def __init__(self, cursor, timeout: float | None = None,
+                 signals=(signal.SIGINT, signal.SIGTERM)):
+        self.cursor = cursor
+        self.timeout = timeout
+        self.signals = signals
+        self.reason = None
+
+    def __enter__(self):
+        self.deadline = time.monotonic() + self.timeout if self.timeout else None
+        self.rsock, self.wsock = socket.socketpair()
+        self.wsock.setblocking(False)
+        self.handlers = {}
+        if self.signals and threading.current_thread() is threading.main_thread():
+            for signum in self.signals:
+                self.handlers[signum] = signal.signal(signum, self._handle_signal)
+            self.wakeup_fd = signal.set_wakeup_fd(self.wsock.fileno())
+        self.thread = threading.Thread(target=self._watch, daemon=True)
+        self.thread.start()
+        return self
+
+    def _handle_signal(self, signum, frame):
+        self._cancel(signal.Signals(signum).name)
+
+    def _cancel(self, reason):
+        if self.reason is None:
+            self.reason = reason
+            log.warning(f'cancelling query ({reason})')
+            self.cursor.cancel()
+
+    def _watch(self):
+        timeout = max(self.deadline - time.monotonic(), 0) if self.deadline else None
+        ready, _, _ = select.select([self.rsock], [], [], timeout)
+        if not ready:
+            self._cancel('timeout')
+            return
+        signum = self.rsock.recv(1)[0]
+        if signum:
+            self._cancel(signal.Signals(signum).name)
+
+    def check(self):
+        """Raise QueryCancelled if the statement was cancelled"""
+        if self.reason:
+            raise QueryCancelled(self.reason)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.handlers:
+            signal.set_wakeup_fd(self.wakeup_fd)
+            for signum, handler in self.handlers.items():
+                signal.signal(signum, handler)
+        # a null byte stops the watchdog thread
+        try:
+            self.wsock.send(b'\0')
+        except OSError:
+            pass
+        self.thread.join()
+        self.rsock.close()
+        self.wsock.close()
+
+
+class ServerStats:
+    """Collects statistics reported by the server for a query.
+
+    With SET STATISTICS IO and TIME, the server sends informational
+    messages for each statement ("Table 'x'. Scan count 1, logical
+    reads 3, ..." and "CPU time = 16 ms, elapsed time = 20 ms"); these
+    are parsed into counts per table and total CPU and elapsed times.
+    If `plans` is True, SET STATISTICS XML is also enabled, and the
+    server returns the actual execution plan of each statement as an
+    additional single-column result set, which is collected in
+    `plans` rather than returned to the caller.
+
+    """
+
+    def __init__(self, plans: bool = False):
+        self.enable_plans = plans
+        self.messages = []
+        self.plans = []
+        self.tables = {}
+        self.times = {'compile': [0, 0], 'execution': [0, 0]}
+        self._phase = 'execution'
+
+    @property
+    def setup_sql(self) -> str:
+        sql = 'set statistics io, time on;'
+        if self.enable_plans:
+            sql += ' set statistics xml on;'
+        return sql
+
+    def add_messages(self, messages: list):
+        """Parse `messages`, a list of tuples (state, text) as provided
+        by cursor.messages
+
+        """
+
+        for _, text in messages:
+            # remove prefixes like '[Microsoft][ODBC Driver 17 for SQL Server][SQL Server]'
+            text = re.sub(r'^(\[[^\]]*\])+', '', text).strip()
+            self.messages.append(text)
+            if 'parse and compile time' in text:
+                self._phase = 'compile'
+            elif 'Execution Times' in text:
+                self._phase = 'execution'
+
+            if mo := re.search(r"Table '([^']+)'\. (.*)", text):
+                # temporary tables are reported using their internal
+                # names, eg '#mrns_____...___00000000000A'
+                table = re.sub(r'_{3,}[0-9A-F]+$', '', mo.group(1))
+                counts = self.tables.setdefault(table, {})
+                for name, value in re.findall(r'([a-z][a-z -]*?) (\d+)', mo.group(2), re.I):
+                    key = name.strip().lower().replace(' ', '_').replace('-', '_')
+                    counts[key] = counts.get(key, 0) + int(value)
+
+            for cpu, elapsed in re.findall(r'CPU time = (\d+) ms,\s+elapsed time = (\d+) ms', text):
+                times = self.times[self._phase]
+                times[0] += int(cpu)
+                times[1] += int(elapsed)
+
+    def add_plan(self, xml: str):
+        self.plans.append(xml)
+
+    def to_dict(self) -> dict:
+        return {
+            'cpu_ms': self.times['execution'][0],
+            'elapsed_ms': self.times['execution'][1],
+            'compile_cpu_ms': self.times['compile'][0],
+            'compile_elapsed_ms': self.times['compile'][1],
+            'logical_reads': sum(t.get('logical_reads', 0) for t in self.tables.values()),
+            'tables': self.tables,
+            'messages': self.messages,
+        }
+
 
 def list_queries() -> list[str]:
-    names = (Path(__file__).parent / 'queries').glob('*.sql')
-    return [name.stem for name in names]
+    return list(registry.load_registry())
 
 
 def get_query(name: str) -> str:
-    query_file = Path(__file__).parent / 'queries' / f'{name}.sql'
-    with open(query_file, encoding='utf-8') as f:
-        return f.read()
+    return registry.get(name).sql
 
 
 def render_template(template: str, params: dict) -> tuple[str, list]:
@@ -90,16 +257,297 @@ def sql_query(query: str,
         return (headers, rows)
 
 
-def create_and_load_temp_table(cursor, sql_cmd: str, rows: list):
-    """Create and load a temporary table using the provided schema
-    and data files. Rows is a list of dicts.
+def sample_filter(key: str, pct: float) -> str:
+    """Returns an sql expression that is true for a deterministic
+    sample of approximately `pct` percent of the values of column
+    `key`. Values are selected using a hash of their text, so the same
+    values are selected on every run.
+
+    """
+
+    if not 0 < pct <= 100:
+        raise ValueError('sample percentage must be greater than 0 and at most 100')
+    return ("(cast(hashbytes('MD5', convert(nvarchar(4000), {})) as int) & 2147483647)"
+            " % 10000 < {}").format(key, round(pct * 100))
+
+
+def sample_query(query: str, key: str, pct: float) -> str:
+    """Wraps `query` (a template as described for render_template())
+    to return a deterministic sample of approximately `pct` percent of
+    its rows selected using a hash of column `key` (see
+    sample_filter()). The query must be a single select statement
+    without a common table expression or an 'order by' clause.
+
+    """
+
+    # comments are removed before checking the statement
+    statement = re.sub(r'--[^\n]*', '', query).strip().rstrip(';').strip()
+    if (not re.match(r'select\b', statement, re.I)
+            or ';' in statement
+            or re.search(r'\border\s+by\b', statement, re.I)):
+        raise ValueError("sampling requires a single select statement without 'order by'")
+    return f'select * from (\n{statement}\n) as sampled\nwhere {sample_filter(key, pct)}'
+
+
+def limit_query(sql: str, limit: int) -> str | None:
+    """Returns `sql` with 'top (limit)' added to its select list if it
+    is a single select statement without 'top', a common table
+    expression or a set operator (union, except or intersect), or None
+    otherwise.
+
+    """
+
+    # comments are removed before checking the statement
+    statement = re.sub(r'--[^\n]*', '', sql).strip().rstrip(';').strip()
+    if (not re.match(r'select\b', statement, re.I)
+            or re.match(r'select\s+((all|distinct)\s+)?top\b', statement, re.I)
+            or ';' in statement
+            or re.search(r'\b(union|except|intersect)\b', statement, re.I)):
+        return None
+    return re.sub(r'^((\s|--[^\n]*)*select\s+((all|distinct)\s+)?)',
+                  rf'\1top ({int(limit)}) ', sql, count=1, flags=re.I)
+
+
+def result_set_names(sql: str) -> list[str]:
+    """Returns names of result sets declared in a query using comments
+    of the form '-- resultset: name', in order of appearance. Raises
+    ValueError if a name is used more than once.
+
     """
+    names = re.findall(r'^\s*--\s*resultset:\s*(\S+)', sql, re.M | re.I)
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f'result set names are used more than once: {", ".join(duplicates)}')
+    return names
 
+
+def fetch_chunks(cursor, headers: list, fetch_size: int = FETCH_SIZE) -> Iterator[list]:
+    """Yields lists of up to `fetch_size` rows of the current result
+    set of `cursor`, deserializing columns with names ending in
+    '__json'.
+
+    """
+    while chunk := cursor.fetchmany(fetch_size):
+        yield deserialize_json(headers, chunk)
+
+
+def fetch_rows(cursor, headers: list, fetch_size: int = FETCH_SIZE) -> Iterator:
+    """Yields rows of the current result set of `cursor`, retrieving
+    `fetch_size` rows at a time and deserializing columns with names
+    ending in '__json'.
+
+    """
+    for chunk in fetch_chunks(cursor, headers, fetch_size):
+        yield from chunk
+
+
+def iter_result_sets(query: str,
+                     params: dict | None = None,
+                     callback: FunctionType | None = None,
+                     fetch_size: int = FETCH_SIZE,
+                     timeout: float | None = None,
+                     stats: ServerStats | None = None,
+                     limit: int | None = None) -> Iterator[tuple[str, list, Iterator]]:
+    """Executes a SQL query that may return more than one result set
+    using a single connection. Parameters and 'callback' are as
+    described for sql_query().
+
+    Yields a tuple (name, headers, rows) for each result set, where
+    'rows' is an iterator over the rows of the result set that must be
+    consumed before advancing to the next result set. Result sets are
+    named using comments of the form '-- resultset: name' in the query
+    (in order), or numbered starting with '1' if not named; if any
+    result set is named, all must be (see cursor_result_sets()).
+    Statements that do not return rows are skipped.
+
+    The query is cancelled if it has not completed within 'timeout'
+    seconds or if the process receives SIGINT or SIGTERM, in which
+    case QueryCancelled is raised after the rows retrieved so far have
+    been yielded. The timeout does not include the callback (eg,
+    loading a temporary table).
+
+    If `stats` is a ServerStats instance, statistics are enabled for
+    the query (but not the callback) and collected in `stats` as
+    result sets are consumed.
+
+    If `limit` is provided, a query consisting of a single select
+    statement returns at most `limit` rows (see limit_query()).
+    Otherwise, the server stops each statement of the query after
+    `limit` rows (SET ROWCOUNT), which also truncates intermediate
+    statements (eg, insert, update, delete or select into).
+
+    """
+
+    params = params or {}
+    sql, bind_params = render_template(query, params)
+    names = result_set_names(sql)
+    if limit and (limited := limit_query(sql, limit)):
+        sql, limit = limited, None
+    elif limit:
+        log.warning(f'limiting each statement to {limit} rows using SET ROWCOUNT')
+
+    conn = pyodbc.connect(CONNECTION_STRING)
+    with conn:
+        if callback:
+            callback(cursor=conn.cursor())
+
+        if timeout:
+            # applies to statements executed by cursors created after it
+            # is set, so it does not limit the callback; rounded up so
+            # that the watchdog deadline passes first
+            conn.timeout = math.ceil(timeout)
+        cursor = conn.cursor()
+        if stats:
+            cursor.execute(stats.setup_sql)
+        if limit:
+            cursor.execute(f'set rowcount {int(limit)}')
+
+        with Watchdog(cursor, timeout=timeout) as watchdog:
+            try:
+                cursor.execute(sql, bind_params)
+                for name, headers, rows in cursor_result_sets(cursor, names, fetch_size, stats):
+                    yield name, headers, guard_rows(rows, watchdog)
+            except pyodbc.Error as err:
+                watchdog.check()
+                # HYT00 indicates that the server timeout expired
+                if timeout and (time.monotonic() >= watchdog.deadline
+                                or err.args[:1] == ('HYT00',)):
+                    raise QueryCancelled('timeout')
+                raise
+            watchdog.check()
+
+
+def guard_rows(rows: Iterator, watchdog: Watchdog) -> Iterator:
+    """Yields from `rows` until the watchdog cancels the statement"""
+    try:
+        for row in rows:
+            if watchdog.reason:
+                break
+            yield row
+    except pyodbc.Error:
+        watchdog.check()
+        raise
+    watchdog.check()
+
+
+def is_showplan(headers: list) -> bool:
+    """True if `headers` describe a result set containing an execution
+    plan returned with SET STATISTICS XML ON
+
+    """
+    return len(headers) == 1 and 'Showplan' in headers[0]
+
+
+def cursor_result_sets(cursor, names: list[str] | None = None,
+                       fetch_size: int = FETCH_SIZE,
+                       stats: ServerStats | None = None) -> Iterator[tuple[str, list, Iterator]]:
+    """Yields (name, headers, rows) for each result set of a cursor on
+    which a query has been executed (see iter_result_sets()). If
+    `stats` is provided, messages and execution plans are added to it.
+
+    If `names` is provided, the query must return one result set for
+    each name; ValueError is raised when the number of result sets
+    differs, since names are assigned by position.
+
+    """
+
+    names = names or []
+    index = 0
+    while True:
+        if stats:
+            # messages from the most recent call to execute() or nextset()
+            stats.add_messages(getattr(cursor, 'messages', None) or [])
+        if cursor.description:
+            headers = [column[0] for column in cursor.description]
+            if stats and is_showplan(headers):
+                for row in cursor.fetchall():
+                    stats.add_plan(row[0])
+            else:
+                if names and index >= len(names):
+                    raise ValueError(f'query returned more than the {len(names)} '
+                                     'named result sets; name every result set')
+                name = names[index] if index < len(names) else str(index + 1)
+                index += 1
+                yield (name,
+                       [header.replace('__json', '') for header in headers],
+                       fetch_rows(cursor, headers, fetch_size))
+        if not cursor.nextset():
+            break
+
+    if names and index < len(names):
+        raise ValueError(f'query returned {index} of the {len(names)} named result sets')
+
+
+def query_columns(query: str,
+                  params: dict | None = None,
+                  callback: FunctionType | None = None,
+                  fetch_size: int = FETCH_SIZE) -> 'columnar.ColumnarResult':
+    """Executes a SQL query and returns the first result set as a
+    columnar.ColumnarResult, which stores each column in a NumPy array
+    filled from chunks of `fetch_size` rows. Parameters and 'callback'
+    are as described for sql_query(). Requires numpy.
+
+    For example, to create a pandas DataFrame:
+
+      df = db.query_columns(query, params).to_pandas()
+
+    """
+
+    from dawgtools import columnar
+
+    params = params or {}
+    sql, bind_params = render_template(query, params)
+
+    conn = pyodbc.connect(CONNECTION_STRING)
+    with conn:
+        cursor = conn.cursor()
+        if callback:
+            callback(cursor=cursor)
+
+        cursor.execute(sql, bind_params)
+        while not cursor.description:
+            if not cursor.nextset():
+                return columnar.ColumnarResult([], {})
+
+        headers = [column[0] for column in cursor.description]
+        # deserialized json columns contain python objects
+        description = [
+            (name.replace('__json', ''), None if name.endswith('__json') else type_code)
+            for name, type_code, *_ in cursor.description
+        ]
+        return columnar.from_chunks(description, fetch_chunks(cursor, headers, fetch_size))
+
+
+def temp_table_name(sql_cmd: str) -> str:
+    """Return the name of the table created by `sql_cmd`"""
     if mo := re.search(r'create table ([#a-z_]+)', sql_cmd, re.I):
-        tablename = mo.groups()[0]
+        return mo.groups()[0]
     else:
         raise ValueError('could not find table name')
 
+
+def create_and_load_temp_table(cursor, sql_cmd: str, rows: list,
+                               index: list[str] | None = None,
+                               dedupe: bool = True,
+                               sample: float | None = None,
+                               sample_key: str | None = None):
+    """Create and load a temporary table using the provided schema
+    and data files. Rows is a list of dicts.
+
+    Duplicate rows are removed before loading unless 'dedupe' is
+    False. If 'index' is a list of column names, a clustered index on
+    those columns is created after loading. Statistics are updated
+    after loading so that joins against the table are planned using
+    its actual size.
+
+    If 'sample' is provided, only a deterministic sample of
+    approximately 'sample' percent of the rows is retained, selected
+    using a hash of column 'sample_key' (by default, the first column
+    of the index or of the table; see sample_filter()).
+    """
+
+    tablename = temp_table_name(sql_cmd)
+
     log.info(f"Creating temporary table {tablename}")
     cursor.execute(sql_cmd)
     result = cursor.execute(f'select * from {tablename}')
@@ -107,7 +555,8 @@ def create_and_load_temp_table(cursor, sql_cmd: str, rows: list):
 
     log.info("Loading data into temporary table")
     placeholders = ','.join(['?'] * len(headers))
-    sql_insert = f'insert into "{tablename}" ({', '.join(headers)}) values ({placeholders})'
+    columns = ', '.join(headers)
+    sql_insert = f'insert into "{tablename}" ({columns}) values ({placeholders})'
     log.info(sql_insert)
 
     if len(headers) == 1:
@@ -117,8 +566,29 @@ def create_and_load_temp_table(cursor, sql_cmd: str, rows: list):
         getter = itemgetter(*headers)
         vals = [getter(row) for row in rows]
 
+    if dedupe:
+        nrows = len(vals)
+        vals = list(dict.fromkeys(vals))
+        log.info(f"Removed {nrows - len(vals)} duplicate rows")
+
+    # send parameters in batches rather than one row at a time
+    cursor.fast_executemany = True
     cursor.executemany(sql_insert, vals)
 
+    if sample is not None:
+        key = sample_key or (index[0] if index else headers[0])
+        sql_sample = f'delete from {tablename} where not ({sample_filter(key, sample)})'
+        log.info(sql_sample)
+        cursor.execute(sql_sample)
+
+    if index:
+        sql_index = 'create clustered index ix_{} on {} ({})'.format(
+            tablename.lstrip('#'), tablename, ', '.join(index))
+        log.info(sql_index)
+        cursor.execute(sql_index)
+
+    cursor.execute(f'update statistics {tablename}')
+
 
 def deserialize_json(headers: list, rows: list) -> list:
     json_cols = [i for i, name in enumerate(headers) if name.endswith('__json')]
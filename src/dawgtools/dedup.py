@@ -0,0 +1,204 @@
+"""Grouping of identical and nearly identical documents.
+
+Exact duplicates are grouped by a hash of the whitespace-normalized
+text. Near duplicates are found using MinHash signatures of word
+shingles and locality-sensitive hashing (LSH) over bands of the
+signature, so that the cost grows linearly with the number of
+documents rather than with the number of pairs.
+
+Groups are lists of indices into the input sequence; the first (lowest)
+index in each group is the representative.
+
+MinHash signatures are computed using numpy if it is installed (for
+example, with the 'frames' extra); the pure python implementation
+produces the same signatures but is much slower (about 0.2 s for a
+3,000 word document, compared with a few milliseconds).
+
+"""
+
+import hashlib
+import random
+from typing import Iterable
+
+
+# hash values are less than 2^32 and coefficients are less than 2^31,
+# so a * h + b fits in an unsigned 64-bit integer
+MERSENNE_PRIME = (1 << 31) - 1
+MAX_HASH = MERSENNE_PRIME
+
+
+def _numpy():
+    """Returns the numpy module, or None if it is not installed. numpy
+    is imported only when signatures are computed, so that importing
+    this module is fast.
+
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def normalize(text: str) -> str:
+    """Collapse all runs of whitespace to a single space"""
+    return ' '.join(text.split())
+
+
+def _hash(text: str) -> int:
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=4).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def shingles(text: str, ngram: int = 5) -> set[int]:
+    """Return the set of hashed word n-grams in `text`"""
+    words = text.split()
+    if len(words) <= ngram:
+        return {_hash(' '.join(words))} if words else set()
+    return {_hash(' '.join(words[i:i + ngram]))
+            for i in range(len(words) - ngram + 1)}
+
+
+class MinHasher:
+    """Computes MinHash signatures using `num_perm` universal hash
+    functions drawn from a fixed seed, so that signatures are
+    comparable across runs.
+
+    """
+
+    def __init__(self, num_perm: int = 128, seed: int = 1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.perms = [(rng.randint(1, MERSENNE_PRIME - 1), rng.randint(0, MERSENNE_PRIME - 1))
+                      for _ in range(num_perm)]
+        self.np = np = _numpy()
+        if np is not None:
+            self.a, self.b = (np.array(col, dtype=np.uint64)[:, None] for col in zip(*self.perms))
+
+    def signature(self, hashes: set[int], use_numpy: bool = True) -> tuple[int, ...]:
+        if not hashes:
+            return (MAX_HASH,) * self.num_perm
+        np = self.np
+        if use_numpy and np is not None:
+            values = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+            return tuple(((self.a * values + self.b) % MERSENNE_PRIME).min(axis=1).tolist())
+        return tuple(
+            min((a * h + b) % MERSENNE_PRIME for h in hashes)
+            for a, b in self.perms
+        )
+
+
+def similarity(sig1: tuple, sig2: tuple) -> float:
+    """Estimate Jaccard similarity from two MinHash signatures"""
+    return sum(x == y for x, y in zip(sig1, sig2)) / len(sig1)
+
+
+def lsh_params(threshold: float, num_perm: int) -> tuple[int, int]:
+    """Choose the number of bands and rows per band so that the LSH
+    similarity threshold (1/b)^(1/r) is closest to `threshold`.
+
+    """
+
+    candidates = []
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        candidates.append((abs((1 / bands) ** (1 / rows) - threshold), bands, rows))
+    _, bands, rows = min(candidates)
+    return bands, rows
+
+
+class UnionFind:
+
+    def __init__(self):
+        self.parent = []
+
+    def add(self) -> int:
+        self.parent.append(len(self.parent))
+        return self.parent[-1]
+
+    def find(self, i: int) -> int:
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i: int, j: int):
+        ri, rj = self.find(i), self.find(j)
+        if ri != rj:
+            # keep the lowest index as the root
+            self.parent[max(ri, rj)] = min(ri, rj)
+
+    def groups(self) -> list[list[int]]:
+        groups = {}
+        for i in range(len(self.parent)):
+            groups.setdefault(self.find(i), []).append(i)
+        return list(groups.values())
+
+
+def exact_groups(texts: Iterable[str]) -> list[list[int]]:
+    """Group documents with identical whitespace-normalized text"""
+    groups = {}
+    for i, text in enumerate(texts):
+        key = hashlib.sha1(normalize(text).encode('utf-8')).digest()
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+
+def near_groups(texts: Iterable[str],
+                threshold: float = 0.9,
+                num_perm: int = 128,
+                ngram: int = 5) -> list[list[int]]:
+    """Group documents with an estimated Jaccard similarity of word
+    n-grams of at least `threshold`. Exact duplicates are always
+    grouped together.
+
+    Each document is compared only with the first document assigned
+    to each LSH bucket it falls into, so grouping is transitive and
+    the number of comparisons is proportional to the number of
+    documents.
+
+    """
+
+    minhasher = MinHasher(num_perm=num_perm)
+    bands, rows = lsh_params(threshold, num_perm)
+
+    exact = {}
+    signatures = {}
+    buckets = [{} for _ in range(bands)]
+
+    uf = UnionFind()
+
+    for text in texts:
+        i = uf.add()
+        text = normalize(text)
+        key = hashlib.sha1(text.encode('utf-8')).digest()
+        if key in exact:
+            uf.union(exact[key], i)
+            continue
+        exact[key] = i
+
+        hashes = shingles(text, ngram)
+        if not hashes:
+            continue
+
+        sig = signatures[i] = minhasher.signature(hashes)
+        for band, bucket in enumerate(buckets):
+            band_key = sig[band * rows:(band + 1) * rows]
+            first = bucket.setdefault(band_key, i)
+            if first != i and uf.find(first) != uf.find(i) \
+               and similarity(signatures[first], sig) >= threshold:
+                uf.union(first, i)
+
+    return uf.groups()
+
+
+def group_documents(texts: Iterable[str],
+                    method: str = 'exact',
+                    threshold: float = 0.9) -> list[list[int]]:
+    """Group documents using `method`, one of 'exact' or 'near'"""
+    if method == 'exact':
+        return exact_groups(texts)
+    elif method == 'near':
+        return near_groups(texts, threshold=threshold)
+    else:
+        raise ValueError(f'unknown deduplication method: {method}')
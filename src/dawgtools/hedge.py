@@ -0,0 +1,135 @@
+"""Hedged requests for reducing tail latency.
+
+A hedged call starts a request and, if it has not completed by the
+time it exceeds a percentile of the latencies observed so far, starts
+a duplicate. The result of whichever request finishes first is
+returned and the other is abandoned. The total number of duplicate
+requests is capped to keep the extra cost bounded.
+
+Requests run in daemon threads so that an abandoned request does not
+delay the exit of the program.
+
+"""
+
+import bisect
+import logging
+import threading
+import time
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+log = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """Maintains a sorted list of observed latencies"""
+
+    def __init__(self):
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self.lock:
+            bisect.insort(self.latencies, seconds)
+
+    def __len__(self):
+        return len(self.latencies)
+
+    def percentile(self, pct: float) -> float | None:
+        """Return the `pct` percentile (0-100) of observed latencies
+        using the nearest-rank method, or None if there are none.
+
+        """
+        with self.lock:
+            if not self.latencies:
+                return None
+            rank = max(int(round(pct / 100 * len(self.latencies))), 1)
+            return self.latencies[min(rank, len(self.latencies)) - 1]
+
+
+def _start(fn, *args, **kwargs) -> Future:
+    """Run fn(*args, **kwargs) in a daemon thread, returning a Future"""
+
+    future = Future()
+    future.set_running_or_notify_cancel()
+
+    def target():
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as err:
+            future.set_exception(err)
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
+class Hedger:
+    """Issues hedged calls. A duplicate request is started when a call
+    has been running longer than the `percentile` of latencies
+    observed so far, as long as at least `min_samples` latencies have
+    been observed and fewer than `max_hedges` duplicates have been
+    issued.
+
+    """
+
+    def __init__(self, percentile: float = 95, max_hedges: int | None = None,
+                 min_samples: int = 10):
+        self.percentile = percentile
+        self.max_hedges = max_hedges
+        self.min_samples = min_samples
+        self.tracker = LatencyTracker()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def threshold(self) -> float | None:
+        if len(self.tracker) < self.min_samples:
+            return None
+        return self.tracker.percentile(self.percentile)
+
+    def _reserve_hedge(self) -> bool:
+        with self.lock:
+            if self.max_hedges is not None and self.hedges >= self.max_hedges:
+                return False
+            self.hedges += 1
+            return True
+
+    def _timed(self, fn, *args, **kwargs):
+        start = time.monotonic()
+        result = fn(*args, **kwargs)
+        self.tracker.record(time.monotonic() - start)
+        return result
+
+    def call(self, fn, *args, **kwargs):
+        """Return the result of fn(*args, **kwargs), hedging the
+        request if it is slow. Raises the exception from the primary
+        request if neither request succeeds.
+
+        """
+
+        with self.lock:
+            self.requests += 1
+
+        primary = _start(self._timed, fn, *args, **kwargs)
+        threshold = self.threshold()
+        done, _ = wait([primary], timeout=threshold)
+        if done or not self._reserve_hedge():
+            return primary.result()
+
+        log.info(f'hedging request after {threshold:.1f}s')
+        hedge = _start(self._timed, fn, *args, **kwargs)
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            succeeded = [f for f in done if f.exception() is None]
+            if succeeded or not pending:
+                future = succeeded[0] if succeeded else primary
+                if future is hedge:
+                    with self.lock:
+                        self.hedge_wins += 1
+                # the other request, if any, is abandoned
+                return future.result()
+
+    def summary(self) -> str:
+        return (f'hedged {self.hedges} of {self.requests} requests; '
+                f'the hedge finished first for {self.hedge_wins}')
@@ -0,0 +1,158 @@
+"""Per-request telemetry for model queries.
+
+Records describe a single input file: whether the result was loaded
+from the cache, the request latency, token usage reported by the
+model, the number of retries, and whether the result was valid.
+Records can be written to a JSONL or CSV sidecar file, and are used to
+display a progress line and a summary at the end of a run.
+
+"""
+
+import csv
+import json
+import sys
+import threading
+import time
+
+FIELDNAMES = ['filename', 'model', 'cache', 'latency', 'input_tokens',
+              'output_tokens', 'cached_tokens', 'retries', 'valid']
+
+
+def usage_counts(response: dict) -> dict:
+    """Return token counts from the 'usage' element of a response"""
+    usage = response.get('usage') or {}
+    details = usage.get('input_tokens_details') or {}
+    return {
+        'input_tokens': usage.get('input_tokens'),
+        'output_tokens': usage.get('output_tokens'),
+        'cached_tokens': details.get('cached_tokens'),
+    }
+
+
+def percentile(values: list, pct: float):
+    """Nearest-rank percentile of `values`, or None if empty"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(pct / 100 * len(values))), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    elif seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds}s'
+
+
+class MetricsWriter:
+    """Writes records to `path` in CSV format if the file name ends
+    with .csv, or JSONL otherwise.
+
+    """
+
+    def __init__(self, path: str):
+        self.fobj = open(path, 'w', newline='')
+        if path.endswith('.csv'):
+            self.writer = csv.DictWriter(self.fobj, fieldnames=FIELDNAMES, extrasaction='ignore')
+            self.writer.writeheader()
+            self.write = self.writer.writerow
+        else:
+            self.write = self._write_json
+
+    def _write_json(self, record: dict):
+        self.fobj.write(json.dumps({k: record.get(k) for k in FIELDNAMES}) + '\n')
+
+    def close(self):
+        self.fobj.close()
+
+
+class Progress:
+    """Accumulates records and displays progress on `stream`. When
+    `stream` is a terminal, a progress line showing throughput, ETA
+    and token throughput is redrawn after each record and messages
+    are printed above it. Methods may be called from several threads.
+
+    """
+
+    def __init__(self, total: int, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.live = stream.isatty()
+        self.start = time.monotonic()
+        self.records = []
+        self.lock = threading.Lock()
+
+    def _clear(self):
+        if self.live:
+            self.stream.write('\r\033[K')
+
+    def message(self, text: str):
+        with self.lock:
+            self._clear()
+            print(text, file=self.stream)
+            self._draw()
+
+    def update(self, record: dict):
+        with self.lock:
+            self.records.append(record)
+            self._draw()
+
+    def tokens(self, key: str, records: list | None = None) -> int:
+        return sum(r.get(key) or 0 for r in (self.records if records is None else records))
+
+    def line(self) -> str:
+        elapsed = time.monotonic() - self.start
+        done = len(self.records)
+        rate = done / elapsed if elapsed else 0
+        eta = format_duration((self.total - done) / rate) if rate else '?'
+        tokens = self.tokens('input_tokens') + self.tokens('output_tokens')
+        return (f'[{done}/{self.total}] {rate:.2f} files/s, ETA {eta}, '
+                f'{tokens / elapsed * 60 if elapsed else 0:,.0f} tokens/min')
+
+    def _draw(self):
+        if self.live:
+            self.stream.write('\r\033[K' + self.line())
+            self.stream.flush()
+
+    def _summary_lines(self, records: list) -> list:
+        requests = [r for r in records if r['cache'] != 'hit']
+        latencies = [r['latency'] for r in requests if r.get('latency') is not None]
+        input_tokens = self.tokens('input_tokens', records)
+        cached_tokens = self.tokens('cached_tokens', records)
+        invalid = sum(r.get('valid') is False for r in records)
+        lines = [
+            f'{len(records) - len(requests)} cached, {len(requests)} requests, '
+            f'{sum(r.get("retries") or 0 for r in requests)} retries'
+            + (f', {invalid} invalid' if invalid else ''),
+            f'tokens: {input_tokens:,} input ({cached_tokens:,} cached, '
+            f'{cached_tokens / input_tokens if input_tokens else 0:.0%}), '
+            f'{self.tokens("output_tokens", records):,} output',
+        ]
+        if latencies:
+            lines.append('latency: p50 {:.1f}s, p95 {:.1f}s, max {:.1f}s'.format(
+                percentile(latencies, 50), percentile(latencies, 95), max(latencies)))
+        return lines
+
+    def summary(self) -> str:
+        """Summarize all records, and each model separately if records
+        describe more than one model.
+
+        """
+
+        elapsed = time.monotonic() - self.start
+        first, *lines = self._summary_lines(self.records)
+        lines.insert(0, f'{len(self.records)} files in {format_duration(elapsed)}: {first}')
+        models = list(dict.fromkeys(r.get('model') for r in self.records))
+        if len(models) > 1:
+            for model in models:
+                lines.append(f'{model}:')
+                lines.extend('  ' + line for line in
+                             self._summary_lines([r for r in self.records if r.get('model') == model]))
+        return '\n'.join(lines)
+
+    def finish(self):
+        self._clear()
+        print(self.summary(), file=self.stream)
@@ -1,7 +1,9 @@
--- parameters:
--- epic_pat_id
--- min_date
--- max-date
+-- description: Notes for a patient with contact dates within a range
+-- param: epic_pat_id str required
+-- param: min_date date required
+-- param: max_date date required
+-- fetch_size: 1000
+-- format: jsonl
 
 WITH note AS (
     SELECT
@@ -1,6 +1,9 @@
--- params - requires one of.
---   case_num: str
---   mrn: str
+-- description: Pathology reports for a case number or a patient mrn
+-- param: case_num str
+-- param: mrn str
+-- one_of: case_num mrn
+-- fetch_size: 1000
+-- format: jsonl
 
 BEGIN;
 
@@ -0,0 +1,175 @@
+"""Registry of the sql queries packaged with dawgtools.
+
+Each file in the ``queries`` directory begins with front matter: sql
+comments of the form ``-- key: value`` preceding the first statement.
+Recognized keys are:
+
+* ``description``: a one-line description of the query
+* ``param``: a parameter, in the form ``name [type] [required]
+  [default=value]``, where type is one of str (the default), int,
+  float, bool, date or datetime; repeat for each parameter
+* ``one_of``: names of parameters of which at least one must be
+  provided
+* ``fetch_size``: the number of rows to retrieve from the server at a
+  time (eg, smaller for queries returning large text values)
+* ``format``: the default output format
+
+For example::
+
+  -- description: Notes for a patient within a range of dates
+  -- param: epic_pat_id str required
+  -- param: min_date date required
+  -- param: max_date date default=2100-01-01
+  -- fetch_size: 1000
+
+Other comments are ignored. The registry is built on first use, and
+parameters can be validated and converted to the declared types before
+connecting to the database.
+
+"""
+
+import re
+from datetime import date, datetime
+from functools import lru_cache
+from pathlib import Path
+
+QUERY_DIR = Path(__file__).parent / 'queries'
+
+
+def to_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in {'1', 'true', 'yes'}:
+        return True
+    if str(value).lower() in {'0', 'false', 'no'}:
+        return False
+    raise ValueError(f'invalid boolean value: {value!r}')
+
+
+def _converter(fn):
+    # values that already have the declared type are not converted
+    return lambda value: fn(value) if isinstance(value, str) else value
+
+
+PARAM_TYPES = {
+    'str': str,
+    'int': int,
+    'float': float,
+    'bool': to_bool,
+    'date': _converter(date.fromisoformat),
+    'datetime': _converter(datetime.fromisoformat),
+}
+
+
+class QueryParam:
+    """A parameter declared using '-- param: name [type] [required] [default=value]'"""
+
+    def __init__(self, name: str, type: str = 'str', required: bool = False, default=None):
+        if type not in PARAM_TYPES:
+            raise ValueError(f'parameter {name} has unknown type {type!r}')
+        self.name = name
+        self.type = type
+        self.required = required
+        self.default = default
+
+    @classmethod
+    def parse(cls, text: str):
+        name, *words = text.split()
+        kwargs = {}
+        for word in words:
+            if word == 'required':
+                kwargs['required'] = True
+            elif word.startswith('default='):
+                kwargs['default'] = word.split('=', 1)[1]
+            else:
+                kwargs['type'] = word
+        return cls(name, **kwargs)
+
+    def convert(self, value):
+        try:
+            return PARAM_TYPES[self.type](value)
+        except ValueError:
+            raise ValueError(f'parameter {self.name}: {value!r} is not a valid {self.type}')
+
+
+class QuerySpec:
+    """A packaged query and the metadata declared in its front matter"""
+
+    def __init__(self, name: str, sql: str, description: str = '',
+                 params: list[QueryParam] | None = None,
+                 one_of: list[list[str]] | None = None,
+                 fetch_size: int | None = None,
+                 format: str | None = None):
+        self.name = name
+        self.sql = sql
+        self.description = description
+        self.params = {param.name: param for param in params or []}
+        self.one_of = one_of or []
+        self.fetch_size = fetch_size
+        self.format = format
+
+    @classmethod
+    def from_file(cls, path: Path):
+        sql = path.read_text(encoding='utf-8')
+        kwargs = {'params': [], 'one_of': []}
+        for line in sql.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith('--'):
+                break
+            mo = re.match(r'--\s*(description|param|one_of|fetch_size|format):\s*(.*)', line)
+            if not mo:
+                continue
+            key, value = mo.group(1), mo.group(2).strip()
+            if key == 'param':
+                kwargs['params'].append(QueryParam.parse(value))
+            elif key == 'one_of':
+                kwargs['one_of'].append(value.split())
+            elif key == 'fetch_size':
+                kwargs['fetch_size'] = int(value)
+            else:
+                kwargs[key] = value
+        return cls(path.stem, sql, **kwargs)
+
+    def validate(self, params: dict) -> dict:
+        """Returns a copy of `params` with defaults added and values
+        converted to the declared types. Raises ValueError if required
+        parameters are missing or values cannot be converted.
+        Undeclared parameters are returned unchanged.
+
+        """
+
+        params = dict(params)
+        for name, param in self.params.items():
+            if params.get(name) in (None, '') and param.default is not None:
+                params[name] = param.default
+
+        missing = [name for name, param in self.params.items()
+                   if param.required and params.get(name) in (None, '')]
+        if missing:
+            raise ValueError(f'query {self.name} requires parameters: {", ".join(missing)}')
+
+        for names in self.one_of:
+            if not any(params.get(name) not in (None, '') for name in names):
+                raise ValueError(
+                    f'query {self.name} requires one of the parameters: {", ".join(names)}')
+
+        for name, value in params.items():
+            if name in self.params and value is not None:
+                params[name] = self.params[name].convert(value)
+        return params
+
+
+@lru_cache
+def load_registry(dirname: Path = QUERY_DIR) -> dict[str, QuerySpec]:
+    """Returns a dict of QuerySpec objects keyed by query name"""
+    specs = (QuerySpec.from_file(path) for path in sorted(Path(dirname).glob('*.sql')))
+    return {spec.name: spec for spec in specs}
+
+
+def get(name: str) -> QuerySpec:
+    registry = load_registry()
+    if name not in registry:
+        raise ValueError(f'no query named {name!r}; choose from {", ".join(registry)}')
+    return registry[name]
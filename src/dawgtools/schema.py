@@ -0,0 +1,177 @@
+"""Validation of values against a JSON Schema.
+
+Supports the subset of JSON Schema used to describe the parameters of
+function tools for structured outputs: type, enum, const, anyOf,
+properties, required, additionalProperties, items, minItems, maxItems,
+minLength, maxLength, pattern, minimum, maximum, and references to
+definitions in the same schema ($ref of the form '#/$defs/name').
+Other keywords are ignored.
+
+A schema is compiled once into a function that returns a list of
+errors for a value, each identifying the location of the error (eg,
+'$.diagnoses[0].code: expected string, got integer').
+
+"""
+
+import re
+from typing import Callable
+
+TYPES = {
+    'string': lambda v: isinstance(v, str),
+    'integer': lambda v: (isinstance(v, int) and not isinstance(v, bool)
+                          or isinstance(v, float) and v.is_integer()),
+    'number': lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    'boolean': lambda v: isinstance(v, bool),
+    'object': lambda v: isinstance(v, dict),
+    'array': lambda v: isinstance(v, list),
+    'null': lambda v: v is None,
+}
+
+
+def type_name(value) -> str:
+    for name in ['null', 'boolean', 'integer', 'number', 'string', 'array', 'object']:
+        if TYPES[name](value):
+            return name
+    return type(value).__name__
+
+
+def _no_errors(value, path):
+    return ()
+
+
+def compile_schema(schema: dict) -> Callable[[object], list[str]]:
+    """Returns a function that returns a list of errors found by
+    validating a value against `schema` (an empty list if the value is
+    valid).
+
+    """
+
+    compiled_refs = {}
+
+    def resolve(ref: str):
+        if ref not in compiled_refs:
+            if not ref.startswith('#/'):
+                raise ValueError(f'unsupported reference: {ref}')
+            target = schema
+            for part in ref[2:].split('/'):
+                target = target[part]
+            # the entry is set before compiling the target so that
+            # recursive references are compiled once
+            compiled_refs[ref] = _no_errors
+            compiled_refs[ref] = build(target)
+
+        def check_ref(value, path):
+            yield from compiled_refs[ref](value, path)
+        return check_ref
+
+    def build(node) -> Callable:
+        if node is True or node == {}:
+            return _no_errors
+        if node is False:
+            return lambda value, path: [f'{path}: no value is allowed']
+
+        checks = []
+        if '$ref' in node:
+            checks.append(resolve(node['$ref']))
+
+        if 'type' in node:
+            types = node['type'] if isinstance(node['type'], list) else [node['type']]
+            tests = [TYPES[t] for t in types]
+
+            def check_type(value, path):
+                if not any(test(value) for test in tests):
+                    yield f'{path}: expected {" or ".join(types)}, got {type_name(value)}'
+            checks.append(check_type)
+
+        if 'enum' in node:
+            enum = node['enum']
+
+            def check_enum(value, path):
+                if value not in enum:
+                    yield f'{path}: {value!r} is not one of {enum}'
+            checks.append(check_enum)
+
+        if 'const' in node:
+            const = node['const']
+
+            def check_const(value, path):
+                if value != const:
+                    yield f'{path}: expected {const!r}'
+            checks.append(check_const)
+
+        if 'anyOf' in node:
+            alternatives = [build(sub) for sub in node['anyOf']]
+
+            def check_any(value, path):
+                if all(list(alt(value, path)) for alt in alternatives):
+                    yield f'{path}: does not match any of the allowed schemas'
+            checks.append(check_any)
+
+        minlength, maxlength = node.get('minLength'), node.get('maxLength')
+        pattern = re.compile(node['pattern']) if 'pattern' in node else None
+        if minlength is not None or maxlength is not None or pattern:
+            def check_string(value, path):
+                if not isinstance(value, str):
+                    return
+                if minlength is not None and len(value) < minlength:
+                    yield f'{path}: shorter than {minlength} characters'
+                if maxlength is not None and len(value) > maxlength:
+                    yield f'{path}: longer than {maxlength} characters'
+                if pattern and not pattern.search(value):
+                    yield f'{path}: does not match {pattern.pattern!r}'
+            checks.append(check_string)
+
+        minimum, maximum = node.get('minimum'), node.get('maximum')
+        if minimum is not None or maximum is not None:
+            def check_number(value, path):
+                if not TYPES['number'](value):
+                    return
+                if minimum is not None and value < minimum:
+                    yield f'{path}: less than {minimum}'
+                if maximum is not None and value > maximum:
+                    yield f'{path}: greater than {maximum}'
+            checks.append(check_number)
+
+        if {'properties', 'required', 'additionalProperties'} & node.keys():
+            properties = {k: build(v) for k, v in node.get('properties', {}).items()}
+            required = node.get('required', [])
+            additional = node.get('additionalProperties', True)
+            check_additional = build(additional) if isinstance(additional, dict) else None
+
+            def check_object(value, path):
+                if not isinstance(value, dict):
+                    return
+                for key in required:
+                    if key not in value:
+                        yield f'{path}: missing required property {key!r}'
+                for key, item in value.items():
+                    if key in properties:
+                        yield from properties[key](item, f'{path}.{key}')
+                    elif additional is False:
+                        yield f'{path}: unexpected property {key!r}'
+                    elif check_additional:
+                        yield from check_additional(item, f'{path}.{key}')
+            checks.append(check_object)
+
+        if {'items', 'minItems', 'maxItems'} & node.keys():
+            items = build(node['items']) if 'items' in node else _no_errors
+            minitems, maxitems = node.get('minItems'), node.get('maxItems')
+
+            def check_array(value, path):
+                if not isinstance(value, list):
+                    return
+                if minitems is not None and len(value) < minitems:
+                    yield f'{path}: fewer than {minitems} items'
+                if maxitems is not None and len(value) > maxitems:
+                    yield f'{path}: more than {maxitems} items'
+                for i, item in enumerate(value):
+                    yield from items(item, f'{path}[{i}]')
+            checks.append(check_array)
+
+        def check(value, path):
+            for fn in checks:
+                yield from fn(value, path)
+        return check
+
+    validate = build(schema)
+    return lambda value: list(validate(value, '$'))
@@ -0,0 +1,145 @@
+import socket
+import threading
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from dawgtools import daemon
+from dawgtools.test_db import FakeCursor
+
+
+class FakeConnection:
+
+    def __init__(self, cursors):
+        self.cursors = cursors
+
+    def cursor(self):
+        return self.cursors.pop(0)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    """Returns (socket_path, cursors); cursors are used in order by
+    the connections created by the server.
+
+    """
+    cursors = []
+    connections = []
+
+    def connect():
+        connections.append(FakeConnection(cursors))
+        return connections[-1]
+
+    socket_path = str(tmp_path / 'test.sock')
+    server = daemon.Server(socket_path, connect=connect)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield socket_path, cursors, connections
+    server.shutdown()
+    server.server_close()
+
+
+def test_encoding():
+    message = {'values': [datetime(2024, 1, 2, 3, 4), Decimal('1.50'), b'\x00', 'text']}
+    assert daemon.loads(daemon.dumps(message)) == message
+
+
+def test_query(server):
+    socket_path, cursors, connections = server
+    cursors.append(FakeCursor([
+        (['a', 'b'], [[1, datetime(2024, 1, 1)], [2, None], [3, None]]),
+        (['c__json'], [['{"x": 1}']]),
+    ]))
+    result_sets = daemon.iter_result_sets(
+        socket_path, '-- resultset: first\nselect %(a)s;\n-- resultset: second\nselect 1', {'a': 1}, fetch_size=2)
+    assert [(name, headers, list(rows)) for name, headers, rows in result_sets] == [
+        ('first', ['a', 'b'], [[1, datetime(2024, 1, 1)], [2, None], [3, None]]),
+        ('second', ['c'], [[{'x': 1}]]),
+    ]
+    assert cursors == [] and len(connections) == 1
+
+
+def test_session_temp_table(server):
+    socket_path, cursors, connections = server
+    temp_table = {'sql_cmd': 'create table #mrns (mrn varchar(102))',
+                  'rows': [{'mrn': 'a'}, {'mrn': 'b'}]}
+    executed = []
+    for _ in range(3):
+        cursor = FakeCursor([(['n'], [[2]])], tables={'#mrns': ['mrn']})
+        cursors.append(cursor)
+        result_sets = daemon.iter_result_sets(
+            socket_path, 'select count(*) as n from #mrns',
+            temp_tables=[temp_table], session='cohort')
+        for name, headers, rows in result_sets:
+            assert list(rows) == [[2]]
+        executed.append([sql for sql, params in cursor.executed])
+
+    # the temporary table is loaded only by the first query
+    assert len(connections) == 1
+    assert executed[0][:2] == ['drop table if exists #mrns', temp_table['sql_cmd']]
+    assert executed[0][-1] == 'select count(*) as n from #mrns'
+    assert executed[1] == executed[2] == ['select count(*) as n from #mrns']
+
+
+def test_error(server):
+    socket_path, cursors, connections = server
+
+    class FailingCursor(FakeCursor):
+        def execute(self, sql, params=None):
+            raise RuntimeError('bad query')
+
+        def cancel(self):
+            pass
+
+    cursors.append(FailingCursor([]))
+    with pytest.raises(daemon.DaemonError, match='bad query'):
+        list(daemon.iter_result_sets(socket_path, 'select 1'))
+
+
+def test_unnamed_temp_table(server):
+    socket_path, cursors, connections = server
+    # temporary tables that exist on the (single) server connection
+    tables = set()
+
+    class TableCursor(FakeCursor):
+        def execute(self, sql, params=None):
+            if sql.startswith('create table '):
+                name = sql.split()[2]
+                if name in tables:
+                    raise RuntimeError(f"There is already an object named '{name}'")
+                tables.add(name)
+            elif sql.startswith('drop table if exists '):
+                tables.discard(sql.split()[-1])
+            return super().execute(sql, params)
+
+    temp_table = {'sql_cmd': 'create table #cohort (mrn varchar(102))',
+                  'rows': [{'mrn': 'a'}]}
+    for _ in range(2):
+        cursors.append(TableCursor([(['n'], [[1]])], tables={'#cohort': ['mrn']}))
+        result_sets = daemon.iter_result_sets(
+            socket_path, 'select count(*) as n from #cohort', temp_tables=[temp_table])
+        for name, headers, rows in result_sets:
+            assert list(rows) == [[1]]
+    assert len(connections) == 1
+
+
+def test_socket_in_use(server, tmp_path):
+    socket_path, cursors, connections = server
+    with pytest.raises(daemon.DaemonError, match='already listening'):
+        daemon.Server(socket_path, connect=lambda: None)
+    # the running server is still reachable
+    cursors.append(FakeCursor([(['a'], [[1]])]))
+    assert [list(rows) for _, _, rows in daemon.iter_result_sets(socket_path, 'select 1')] == [[[1]]]
+
+    # a socket without a server is replaced
+    stale = str(tmp_path / 'stale.sock')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(stale)
+    daemon.Server(stale, connect=lambda: None).server_close()
@@ -1,3 +1,11 @@
+import os
+import signal
+import threading
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+
 from dawgtools import db
 
 
@@ -47,3 +55,328 @@ def test_complex_template():
     expected_params = [42, "shipped"]
     result = db.render_template(template, params)
     assert (normalize_ws(result[0]), result[1]) == (normalize_ws(expected_query), expected_params)
+
+
+class FakeCursor:
+    """Stands in for a pyodbc cursor returning canned result sets,
+    each a tuple (headers, rows); headers is None for statements that
+    do not return rows, optionally followed by a list of messages
+    (state, text). Headers are column names or tuples (name,
+    type_code). `tables` maps names of tables to lists of column names
+    returned by 'select * from <table>'.
+
+    """
+
+    def __init__(self, result_sets, tables=None):
+        self.result_sets = list(result_sets)
+        self.tables = tables or {}
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+        if sql.startswith('select * from ') and sql.split()[-1] in self.tables:
+            return FakeCursor([(self.tables[sql.split()[-1]], [])])
+        return self
+
+    def executemany(self, sql, params):
+        self.executed.append((sql, params))
+
+    @property
+    def description(self):
+        headers = self.result_sets[0][0]
+        if not headers:
+            return None
+        return [header if isinstance(header, tuple) else (header, None) for header in headers]
+
+    @property
+    def messages(self):
+        return self.result_sets[0][2] if len(self.result_sets[0]) > 2 else []
+
+    def fetchmany(self, size):
+        headers, rows, *messages = self.result_sets[0]
+        self.result_sets[0] = (headers, rows[size:], *messages)
+        return rows[:size]
+
+    def fetchall(self):
+        return self.fetchmany(len(self.result_sets[0][1]))
+
+    def nextset(self):
+        self.result_sets.pop(0)
+        return bool(self.result_sets)
+
+
+class FakeError(Exception):
+    pass
+
+
+class FakeConnection:
+    """Returns the same cursor each time, recording the value of
+    `timeout` when each cursor is created
+
+    """
+
+    timeout = 0
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.timeouts = []
+
+    def cursor(self):
+        self.timeouts.append(self.timeout)
+        return self._cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def fake_connect(monkeypatch, cursor):
+    """Returns the connection provided by pyodbc.connect()"""
+    conn = FakeConnection(cursor)
+
+    class pyodbc:
+        Error = FakeError
+
+        @staticmethod
+        def connect(connection_string):
+            return conn
+    monkeypatch.setattr(db, 'pyodbc', pyodbc)
+    return conn
+
+
+def test_result_set_names():
+    sql = """
+    -- resultset: patients
+    select 1;
+    --resultset:  notes
+    select 2;
+    """
+    assert db.result_set_names(sql) == ['patients', 'notes']
+    with pytest.raises(ValueError, match='more than once: notes'):
+        db.result_set_names(sql + '-- resultset: notes\nselect 3;')
+
+
+@pytest.mark.parametrize('result_sets,error', [
+    # an unnamed select preceding the named one
+    ([(['a'], [[1]]), (['b'], [[2]])], 'more than the 1 named result sets'),
+    ([(None, [])], '0 of the 1 named result sets'),
+])
+def test_result_set_names_mismatch(monkeypatch, result_sets, error):
+    fake_connect(monkeypatch, FakeCursor(result_sets))
+    with pytest.raises(ValueError, match=error):
+        collect(db.iter_result_sets('select 1;\n-- resultset: named\nselect 2'), [])
+
+
+def test_iter_result_sets(monkeypatch):
+    cursor = FakeCursor([
+        (None, []),
+        (['a', 'b__json'], [[1, '{"x": 1}'], [2, '[]'], [3, 'null']]),
+        (['c'], [['foo']]),
+    ])
+    fake_connect(monkeypatch, cursor)
+    query = ("-- resultset: first\nselect a, b__json from t where a = %(a)s;\n"
+             "-- resultset: second\nselect c from t")
+    result = [(name, headers, list(rows))
+              for name, headers, rows in db.iter_result_sets(query, {'a': 1}, fetch_size=2)]
+    assert result == [
+        ('first', ['a', 'b'], [[1, {'x': 1}], [2, []], [3, None]]),
+        ('second', ['c'], [['foo']]),
+    ]
+    assert cursor.executed[0][1] == [1]
+
+
+def test_create_and_load_temp_table():
+    cursor = FakeCursor([], tables={'#cohort': ['mrn', 'dt']})
+    rows = [{'mrn': 'a', 'dt': '2024-01-01', 'other': 1},
+            {'mrn': 'b', 'dt': '2024-01-01', 'other': 2},
+            {'mrn': 'a', 'dt': '2024-01-01', 'other': 3}]
+    sql_cmd = 'create table #cohort (mrn varchar(102), dt date)'
+    db.create_and_load_temp_table(cursor, sql_cmd, rows, index=['mrn', 'dt'])
+    assert cursor.executed[2:] == [
+        ('insert into "#cohort" (mrn, dt) values (?,?)',
+         [('a', '2024-01-01'), ('b', '2024-01-01')]),
+        ('create clustered index ix_cohort on #cohort (mrn, dt)', None),
+        ('update statistics #cohort', None),
+    ]
+
+
+def test_sample_temp_table():
+    cursor = FakeCursor([], tables={'#mrns': ['mrn']})
+    sql_cmd = 'create table #mrns (mrn varchar(102))'
+    db.create_and_load_temp_table(cursor, sql_cmd, [{'mrn': 'a'}], index=['mrn'], sample=2.5)
+    assert cursor.executed[3][0] == (
+        "delete from #mrns where not ((cast(hashbytes('MD5', convert(nvarchar(4000), mrn)) "
+        "as int) & 2147483647) % 10000 < 250)")
+
+
+def test_sample_query():
+    query = '-- resultset: notes\nselect * from notes where id = %(id)s;\n'
+    sql, params = db.render_template(db.sample_query(query, 'note_id', 10), {'id': 1})
+    assert normalize_ws(sql).startswith('select * from ( select * from notes where id = ? ) as sampled')
+    assert sql.endswith('convert(nvarchar(4000), note_id)) as int) & 2147483647) % 10000 < 1000')
+    assert params == [1]
+    for query in ['with x as (select 1 as a) select a from x',
+                  'select 1; select 2', 'select a from t order by a']:
+        with pytest.raises(ValueError):
+            db.sample_query(query, 'a', 10)
+    with pytest.raises(ValueError):
+        db.sample_filter('a', 0)
+
+
+def test_limit(monkeypatch):
+    cursor = FakeCursor([(['a'], [[1]])])
+    fake_connect(monkeypatch, cursor)
+    collect(db.iter_result_sets('-- resultset: a\nselect distinct 1', limit=100), [])
+    assert cursor.executed == [('-- resultset: a\nselect distinct top (100) 1', [])]
+
+    cursor = FakeCursor([(None, []), (['a'], [[1]])])
+    fake_connect(monkeypatch, cursor)
+    collect(db.iter_result_sets('select 1 into #a; select a from #a', limit=100), [])
+    assert cursor.executed[0] == ('set rowcount 100', None)
+
+
+def test_limit_query():
+    assert db.limit_query('select * from t order by a;', 5) == 'select top (5) * from t order by a;'
+    for sql in ['select top 10 * from t', 'select distinct top 10 a from t',
+                'with x as (select 1 as a) select a from x', 'select 1; select 2',
+                'select 1 union select 2', 'begin select 1 end']:
+        assert db.limit_query(sql, 5) is None
+
+
+def test_query_columns(monkeypatch):
+    np = pytest.importorskip('numpy')
+    cursor = FakeCursor([
+        (None, []),
+        ([('i', int), ('f', Decimal), ('d', date), ('s', str), ('j__json', str)], [
+            [1, Decimal('1.5'), date(2024, 1, 1), 'a', '{"x": 1}'],
+            [2, None, None, None, '[]'],
+            [None, Decimal('3'), date(2024, 1, 3), 'c', 'null'],
+        ]),
+    ])
+    fake_connect(monkeypatch, cursor)
+    result = db.query_columns('select 1', fetch_size=2)
+    assert result.headers == ['i', 'f', 'd', 's', 'j']
+    assert len(result) == 3
+    columns = result.columns
+    np.testing.assert_array_equal(columns['i'], [1.0, 2.0, np.nan])
+    np.testing.assert_array_equal(columns['f'], [1.5, np.nan, 3.0])
+    assert columns['d'].dtype == np.dtype('datetime64[D]')
+    assert np.isnat(columns['d'][1])
+    assert list(columns['s']) == ['a', None, 'c']
+    assert list(columns['j']) == [{'x': 1}, [], None]
+
+
+def test_query_columns_pandas(monkeypatch):
+    pytest.importorskip('pandas')
+    cursor = FakeCursor([([('i', int), ('t', datetime)], [[1, datetime(2024, 1, 1)], [2, None]])])
+    fake_connect(monkeypatch, cursor)
+    df = db.query_columns('select 1').to_pandas()
+    assert list(df.columns) == ['i', 't']
+    assert df['i'].dtype == 'int64'
+    assert df['t'].isna().tolist() == [False, True]
+
+
+def test_server_stats(monkeypatch):
+    prefix = '[Microsoft][ODBC Driver 17 for SQL Server][SQL Server]'
+    showplan = 'Microsoft SQL Server 2005 XML Showplan'
+    cursor = FakeCursor([
+        (None, [], [
+            ('[01000] (0)', prefix + 'SQL Server parse and compile time: '),
+            ('[01000] (0)', prefix + '   CPU time = 5 ms, elapsed time = 7 ms.'),
+        ]),
+        (['a'], [[1], [2]]),
+        ([showplan], [['<ShowPlanXML/>']], [
+            ('[01000] (0)', prefix + "Table 'Worktable'. Scan count 0, logical reads 0, "
+             "physical reads 0, read-ahead reads 0, lob logical reads 0."),
+            ('[01000] (0)', prefix + "Table 'notes'. Scan count 3, logical reads 120, "
+             "physical reads 2, read-ahead reads 40, lob logical reads 10."),
+            ('[01000] (0)', prefix + "Table '#mrns_______________________00000000000A'. "
+             "Scan count 1, logical reads 2, physical reads 0."),
+            ('[01000] (0)', prefix + ' SQL Server Execution Times:'),
+            ('[01000] (0)', prefix + '   CPU time = 16 ms,  elapsed time = 20 ms.'),
+        ]),
+        (None, [], [
+            ('[01000] (0)', prefix + "Table 'notes'. Scan count 1, logical reads 30."),
+            ('[01000] (0)', prefix + ' SQL Server Execution Times:'),
+            ('[01000] (0)', prefix + '   CPU time = 4 ms,  elapsed time = 10 ms.'),
+        ]),
+    ])
+    fake_connect(monkeypatch, cursor)
+    stats = db.ServerStats(plans=True)
+    rows = []
+    collect(db.iter_result_sets('select 1', stats=stats), rows)
+    assert rows == [[1], [2]]
+    assert cursor.executed[0][0] == 'set statistics io, time on; set statistics xml on;'
+    assert stats.plans == ['<ShowPlanXML/>']
+    summary = stats.to_dict()
+    assert summary['tables']['notes'] == {
+        'scan_count': 4, 'logical_reads': 150, 'physical_reads': 2,
+        'read_ahead_reads': 40, 'lob_logical_reads': 10}
+    assert summary['tables']['#mrns']['logical_reads'] == 2
+    assert summary['logical_reads'] == 152
+    assert (summary['cpu_ms'], summary['elapsed_ms']) == (20, 30)
+    assert (summary['compile_cpu_ms'], summary['compile_elapsed_ms']) == (5, 7)
+    assert summary['messages'][0] == 'SQL Server parse and compile time:'
+
+
+class BlockingCursor(FakeCursor):
+    """Returns one chunk of rows, then blocks until cancelled"""
+
+    def __init__(self):
+        super().__init__([(['a'], [[1], [2]])])
+        self.cancelled = threading.Event()
+
+    def fetchmany(self, size):
+        chunk = super().fetchmany(size)
+        if chunk:
+            return chunk
+        self.cancelled.wait(5)
+        raise FakeError('Operation canceled')
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+def collect(result_sets, rows):
+    for name, headers, result in result_sets:
+        rows.extend(result)
+
+
+def test_timeout(monkeypatch):
+    cursor = BlockingCursor()
+    fake_connect(monkeypatch, cursor)
+    rows = []
+    with pytest.raises(db.QueryCancelled, match='timeout'):
+        collect(db.iter_result_sets('select 1', timeout=0.1), rows)
+    assert rows == [[1], [2]]
+    assert cursor.cancelled.is_set()
+
+
+def test_server_timeout(monkeypatch):
+    class TimeoutCursor(FakeCursor):
+        def execute(self, sql, params=None):
+            raise FakeError('HYT00', '[HYT00] Query timeout expired')
+
+    conn = fake_connect(monkeypatch, TimeoutCursor([]))
+    callback_timeouts = []
+    with pytest.raises(db.QueryCancelled, match='timeout'):
+        collect(db.iter_result_sets(
+            'select 1', timeout=1.5,
+            callback=lambda cursor: callback_timeouts.append(conn.timeout)), [])
+    # the timeout is rounded up and does not apply to the callback
+    assert callback_timeouts == [0]
+    assert conn.timeouts == [0, 2]
+
+
+def test_signal(monkeypatch):
+    cursor = BlockingCursor()
+    fake_connect(monkeypatch, cursor)
+    handler = signal.getsignal(signal.SIGTERM)
+    threading.Timer(0.1, os.kill, (os.getpid(), signal.SIGTERM)).start()
+    rows = []
+    with pytest.raises(db.QueryCancelled, match='SIGTERM'):
+        collect(db.iter_result_sets('select 1'), rows)
+    assert rows == [[1], [2]]
+    assert signal.getsignal(signal.SIGTERM) is handler
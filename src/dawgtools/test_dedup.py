@@ -0,0 +1,36 @@
+import pytest
+
+from dawgtools import dedup
+
+NOTE = ' '.join(f'word{i}' for i in range(200))
+
+
+def test_exact_groups():
+    texts = ['a b  c', 'x y z', 'a b c\n', 'x y']
+    assert dedup.exact_groups(texts) == [[0, 2], [1], [3]]
+
+
+def test_near_groups():
+    near = NOTE.replace('word100', 'changed')
+    other = ' '.join(f'other{i}' for i in range(200))
+    texts = [NOTE, other, near, NOTE + '\n', '']
+    assert sorted(dedup.near_groups(texts, threshold=0.8)) == [[0, 2, 3], [1], [4]]
+
+
+def test_near_groups_below_threshold():
+    half = ' '.join(f'word{i}' for i in range(100)) + ' ' + \
+        ' '.join(f'other{i}' for i in range(100))
+    assert sorted(dedup.near_groups([NOTE, half], threshold=0.9)) == [[0], [1]]
+
+
+def test_lsh_params():
+    bands, rows = dedup.lsh_params(0.9, 128)
+    assert bands * rows <= 128
+    assert abs((1 / bands) ** (1 / rows) - 0.9) < 0.05
+
+
+def test_signature_numpy():
+    pytest.importorskip('numpy')
+    minhasher = dedup.MinHasher(num_perm=16)
+    hashes = dedup.shingles(NOTE)
+    assert minhasher.signature(hashes) == minhasher.signature(hashes, use_numpy=False)
@@ -0,0 +1,227 @@
+import argparse
+import csv
+import json
+import time
+
+import openai
+import pytest
+
+from dawgtools.commands import extract_batch
+from dawgtools.schema import compile_schema
+
+
+class FakeResponses:
+
+    def __init__(self):
+        self.requests = []
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        return kwargs
+
+
+class FakeClient:
+
+    def __init__(self, base_url=None):
+        self.responses = FakeResponses()
+        if base_url:
+            self.base_url = type('URL', (), {'host': base_url})()
+
+
+@pytest.mark.parametrize('order,expected', [
+    ('prompt-first', ['the prompt', 'the document']),
+    ('document-first', ['the document', 'the prompt']),
+])
+def test_get_features_order(order, expected):
+    client = FakeClient()
+    request = extract_batch.get_features(
+        client, 'the document', tools=[], model='m', prompt='the prompt', order=order)
+    assert [message['content'] for message in request['input']] == expected
+    request = extract_batch.get_features(client, 'the document', tools=[], model='m')
+    assert [message['content'] for message in request['input']] == ['the document']
+
+
+def test_is_openai_endpoint():
+    assert extract_batch.is_openai_endpoint(FakeClient('api.openai.com'))
+    assert not extract_batch.is_openai_endpoint(FakeClient('localhost'))
+    assert not extract_batch.is_openai_endpoint(FakeClient())
+
+
+class FakeResponse:
+
+    def __init__(self, data):
+        self.data = data
+
+    def to_dict(self):
+        return self.data
+
+    def to_json(self):
+        return json.dumps(self.data)
+
+
+class RequestFailed(openai.OpenAIError):
+    pass
+
+
+class FakeModelResponses:
+    """Returns a single tool call with arguments {'value':
+    '<model>:<document>'}, or {} for documents in `invalid`. Requests
+    for documents in `failed` raise RequestFailed. Documents for
+    which features were requested are added to `requested`.
+
+    """
+
+    invalid = set()
+    failed = set()
+    requested = []
+
+    def create(self, model, input, **kwargs):
+        document = input[-1]['content']
+        self.requested.append(document)
+        if document in self.failed:
+            raise RequestFailed('no response')
+        arguments = {} if document in self.invalid else {'value': f'{model}:{document}'}
+        return FakeResponse({
+            'output': [{'arguments': json.dumps(arguments)}],
+            'usage': {'input_tokens': 10, 'output_tokens': 1},
+        })
+
+
+class FakeOpenAI:
+
+    def __init__(self, **kwargs):
+        self.responses = FakeModelResponses()
+
+
+SCHEMA = {'type': 'function', 'name': 'extract', 'parameters': {
+    'type': 'object', 'properties': {'value': {'type': 'string'}}, 'required': ['value']}}
+
+
+def test_rate_limiter():
+    limiter = extract_batch.RateLimiter(rpm=1200)
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.1
+    start = time.monotonic()
+    for _ in range(3):
+        extract_batch.RateLimiter().acquire()
+    assert time.monotonic() - start < 0.05
+
+
+def test_model_runner(tmp_path):
+    runner = extract_batch.ModelRunner(
+        client=FakeOpenAI(), model='m1', tools=[SCHEMA], cache_dir=tmp_path,
+        validate=compile_schema(SCHEMA['parameters']))
+    infile = tmp_path / 'a.txt'
+    features, record = runner.process(infile, 'text')
+    assert features == [{'value': 'm1:text'}]
+    assert record['cache'] == 'miss' and record['valid'] and record['input_tokens'] == 10
+    assert (tmp_path / 'a-m1.json').exists()
+    assert runner.process(infile, 'text')[1]['cache'] == 'hit'
+    assert runner.process(infile, 'text', refresh=True)[1]['cache'] == 'miss'
+
+
+def run(tmp_path, monkeypatch, *argv, invalid=(), failed=(), schema=SCHEMA):
+    """Run extract_batch on files a.txt, b.txt (a copy of a.txt) and
+    c.txt, returning the rows of the output. Features are invalid for
+    documents in `invalid`, and requests fail for documents in
+    `failed`. Features are extracted using `schema`.
+
+    """
+
+    monkeypatch.setattr(extract_batch, 'OpenAI', FakeOpenAI)
+    monkeypatch.setattr(FakeModelResponses, 'invalid', set(invalid))
+    monkeypatch.setattr(FakeModelResponses, 'failed', set(failed))
+    monkeypatch.setattr(FakeModelResponses, 'requested', [])
+    indir = tmp_path / 'in'
+    indir.mkdir(exist_ok=True)
+    for name, text in [('a', 'A'), ('b', 'A'), ('c', 'C')]:
+        (indir / f'{name}.txt').write_text(text)
+    schema_file = tmp_path / 'schema.json'
+    schema_file.write_text(json.dumps(schema))
+    outfile = tmp_path / 'out.csv'
+
+    parser = argparse.ArgumentParser()
+    extract_batch.build_parser(parser)
+    args = parser.parse_args(
+        [*argv, str(schema_file), '-d', str(indir), '-o', str(outfile),
+         '--cache-dir', str(tmp_path / 'cache')])
+    extract_batch.action(args)
+    args.outfile.close()
+    with open(outfile, newline='') as f:
+        return list(csv.reader(f))
+
+
+def test_long_output(tmp_path, monkeypatch):
+    rows = run(tmp_path, monkeypatch, '-m', 'm1', '-m', 'm2', '-j', '2')
+    assert rows == [
+        ['filename', 'model', 'value', 'errors'],
+        ['a.txt', 'm1', 'm1:A', ''], ['a.txt', 'm2', 'm2:A', ''],
+        ['b.txt', 'm1', 'm1:A', ''], ['b.txt', 'm2', 'm2:A', ''],
+        ['c.txt', 'm1', 'm1:C', ''], ['c.txt', 'm2', 'm2:C', ''],
+    ]
+
+
+def test_wide_output(tmp_path, monkeypatch):
+    rows = run(tmp_path, monkeypatch, '-m', 'm1', '-m', 'm2', '--wide', '--dedup', 'exact')
+    assert rows == [
+        ['filename', 'representative', 'm1.value', 'm1.errors', 'm2.value', 'm2.errors'],
+        ['a.txt', 'a.txt', 'm1:A', '', 'm2:A', ''],
+        ['b.txt', 'a.txt', 'm1:A', '', 'm2:A', ''],
+        ['c.txt', 'c.txt', 'm1:C', '', 'm2:C', ''],
+    ]
+
+
+def test_default_model(tmp_path, monkeypatch):
+    rows = run(tmp_path, monkeypatch)
+    assert rows[1] == ['a.txt', 'gpt-5.2', 'gpt-5.2:A', '']
+
+
+@pytest.mark.parametrize('output,features,errors', [
+    ([{'arguments': '{"value": "x"}'}], [{'value': 'x'}], []),
+    ([{'arguments': '{}'}], [{}], ["call 0: $: missing required property 'value'"]),
+    ([{'arguments': '{"value": 1}'}, {'arguments': '{"value'}], [{'value': 1}],
+     ['call 0: $.value: expected string, got integer', 'call 1: malformed arguments']),
+    ([{'type': 'message'}], [], ['no tool call in response']),
+])
+def test_check_features(output, features, errors):
+    validate = compile_schema(SCHEMA['parameters'])
+    result = extract_batch.check_features({'output': output}, validate)
+    assert result[0] == features
+    assert len(result[1]) == len(errors)
+    assert all(e.startswith(expected) for e, expected in zip(result[1], errors))
+
+
+def test_retry_invalid(tmp_path, monkeypatch):
+    rows = run(tmp_path, monkeypatch, invalid={'C'})
+    # invalid results are written with a description of the problem
+    assert rows[3] == ['c.txt', 'gpt-5.2', '', "call 0: $: missing required property 'value'"]
+    manifest = json.loads(next((tmp_path / 'cache').glob('*/manifest.json')).read_text())
+    assert [item['filename'] for item in manifest['invalid']] == ['c.txt']
+
+    # only the invalid file is requested again
+    rows = run(tmp_path, monkeypatch, '--retry-invalid')
+    assert FakeModelResponses.requested == ['C']
+    assert rows[3] == ['c.txt', 'gpt-5.2', 'gpt-5.2:C', '']
+    manifest = json.loads(next((tmp_path / 'cache').glob('*/manifest.json')).read_text())
+    assert manifest['invalid'] == []
+
+
+def test_failed_request(tmp_path, monkeypatch):
+    rows = run(tmp_path, monkeypatch, failed={'C'})
+    # results of other files are written, and the failure is recorded
+    assert rows[1] == ['a.txt', 'gpt-5.2', 'gpt-5.2:A', '']
+    assert rows[3] == ['c.txt', 'gpt-5.2', '', 'request failed (RequestFailed: no response)']
+    manifest = json.loads(next((tmp_path / 'cache').glob('*/manifest.json')).read_text())
+    assert [item['filename'] for item in manifest['invalid']] == ['c.txt']
+
+    rows = run(tmp_path, monkeypatch, '--retry-invalid')
+    assert FakeModelResponses.requested == ['C']
+    assert rows[3] == ['c.txt', 'gpt-5.2', 'gpt-5.2:C', '']
+
+
+def test_reserved_property(tmp_path, monkeypatch):
+    schema = {**SCHEMA, 'parameters': {'type': 'object', 'properties': {'errors': {}}}}
+    with pytest.raises(SystemExit, match='conflict with output columns: errors'):
+        run(tmp_path, monkeypatch, schema=schema)
@@ -0,0 +1,97 @@
+import csv
+import json
+from pathlib import Path
+
+import pytest
+
+from dawgtools.commands import extract_merge
+from dawgtools.commands.extract_batch import inputs_digest, parse_shard, shard_of
+
+FILES = [Path(f'note{i}.txt') for i in range(200)]
+
+
+def test_parse_shard():
+    assert parse_shard('2/4') == (2, 4)
+    for shard in ['0/4', '5/4', '2', 'a/b']:
+        with pytest.raises(Exception):
+            parse_shard(shard)
+
+
+def test_shard_of():
+    shards = [shard_of(f, 4) for f in FILES]
+    # every file is assigned to exactly one shard, and each shard is used
+    assert set(shards) == {1, 2, 3, 4}
+    # assignment depends only on the file name
+    assert [shard_of(Path('/other/dir') / f, 4) for f in FILES] == shards
+    assert shard_of(Path('note0.txt'), 4) == 3
+    assert shard_of(Path('note1.txt'), 4) == 4
+
+
+def write_shards(tmp_path, nshards=2, rows=None, updates=None):
+    """Write an output file and manifest for each shard, where `rows`
+    maps file names to lists of feature values and `updates` maps
+    shard numbers to values replacing those in the manifest
+
+    """
+
+    rows = rows or {f.name: ['x'] for f in FILES[:10]}
+    names = sorted(rows)
+    paths = []
+    for k in range(1, nshards + 1):
+        files = [name for name in names if shard_of(Path(name), nshards) == k]
+        outfile = tmp_path / f'out{k}.csv'
+        with open(outfile, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['filename', 'model', 'feature'])
+            # rows are not necessarily ordered by file name
+            for name in reversed(files):
+                writer.writerows([name, 'm', value] for value in rows[name])
+        manifest = {
+            'shard': k, 'nshards': nshards, 'schema_hash': 'abc', 'models': ['m'],
+            'ninputs': len(names), 'inputs_digest': inputs_digest([Path(n) for n in names]),
+            'outfile': str(outfile), 'files': {name: {'representative': name} for name in files},
+        }
+        manifest.update((updates or {}).get(k, {}))
+        path = tmp_path / f'manifest-{k}-of-{nshards}.json'
+        path.write_text(json.dumps(manifest))
+        paths.append(path)
+    return paths
+
+
+def merge(paths):
+    manifests = extract_merge.load_manifests(paths)
+    shards = [extract_merge.read_shard(m, None)[1] for m in manifests]
+    return [(row['filename'], row['feature']) for row in
+            extract_merge.heapq.merge(*shards, key=lambda row: row['filename'])]
+
+
+def test_merge(tmp_path):
+    rows = {f.name: ['a', 'b'] for f in FILES[:10]}
+    # a file without results is allowed
+    rows['note5.txt'] = []
+    merged = merge(write_shards(tmp_path, 3, rows))
+    assert [name for name, _ in merged] == sorted(
+        name for name, values in rows.items() for _ in values)
+    assert merged[:2] == [('note0.txt', 'a'), ('note0.txt', 'b')]
+
+
+def test_missing_shard(tmp_path):
+    paths = write_shards(tmp_path, 3)
+    with pytest.raises(extract_merge.MergeError, match=r'missing: \[2\]'):
+        extract_merge.load_manifests([paths[0], paths[2]])
+
+
+def test_inconsistent_shards(tmp_path):
+    paths = write_shards(tmp_path, 2, updates={2: {'schema_hash': 'def'}})
+    with pytest.raises(extract_merge.MergeError, match='inconsistent values for schema_hash'):
+        extract_merge.load_manifests(paths)
+
+
+def test_unexpected_rows(tmp_path):
+    paths = write_shards(tmp_path, 2, updates={1: {'files': {}}})
+    with pytest.raises(extract_merge.MergeError, match='input files'):
+        extract_merge.load_manifests(paths)
+    manifest = json.loads(paths[0].read_text())
+    manifest['path'] = paths[0]
+    with pytest.raises(extract_merge.MergeError, match='not in the manifest'):
+        extract_merge.read_shard(manifest, None)
@@ -0,0 +1,43 @@
+import time
+
+from dawgtools import hedge
+
+
+def test_percentile():
+    tracker = hedge.LatencyTracker()
+    assert tracker.percentile(95) is None
+    for i in range(100, 0, -1):
+        tracker.record(i)
+    assert tracker.percentile(95) == 95
+    assert tracker.percentile(50) == 50
+    assert tracker.percentile(0) == 1
+
+
+def test_no_hedge_without_samples():
+    hedger = hedge.Hedger(percentile=95, min_samples=5)
+    assert hedger.call(lambda x: x * 2, 2) == 4
+    assert (hedger.requests, hedger.hedges) == (1, 0)
+
+
+def test_hedge_slow_request():
+    delays = iter([0.01] * 5 + [5, 0.01])
+
+    def request():
+        time.sleep(next(delays))
+        return 'done'
+
+    hedger = hedge.Hedger(percentile=95, min_samples=5)
+    for _ in range(5):
+        hedger.call(request)
+
+    start = time.monotonic()
+    assert hedger.call(request) == 'done'
+    assert time.monotonic() - start < 1
+    assert (hedger.requests, hedger.hedges, hedger.hedge_wins) == (6, 1, 1)
+
+
+def test_hedge_cap():
+    hedger = hedge.Hedger(percentile=50, min_samples=1, max_hedges=0)
+    hedger.tracker.record(0.0)
+    assert hedger.call(lambda: time.sleep(0.05) or 'done') == 'done'
+    assert hedger.hedges == 0
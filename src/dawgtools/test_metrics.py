@@ -0,0 +1,34 @@
+import io
+
+from dawgtools import metrics
+
+
+def test_usage_counts():
+    response = {'usage': {'input_tokens': 100, 'output_tokens': 10,
+                          'input_tokens_details': {'cached_tokens': 64}}}
+    assert metrics.usage_counts(response) == {
+        'input_tokens': 100, 'output_tokens': 10, 'cached_tokens': 64}
+    assert metrics.usage_counts({}) == {
+        'input_tokens': None, 'output_tokens': None, 'cached_tokens': None}
+
+
+def test_progress_summary():
+    progress = metrics.Progress(total=3, stream=io.StringIO())
+    progress.update({'cache': 'hit'})
+    for latency in [1.0, 3.0]:
+        progress.update({'cache': 'miss', 'latency': latency, 'retries': 1,
+                         'input_tokens': 100, 'output_tokens': 10, 'cached_tokens': 50})
+    summary = progress.summary()
+    assert '1 cached, 2 requests, 2 retries' in summary
+    assert 'tokens: 200 input (100 cached, 50%), 20 output' in summary
+    assert 'p50 1.0s, p95 3.0s, max 3.0s' in summary
+
+
+def test_progress_summary_models():
+    progress = metrics.Progress(total=2, stream=io.StringIO())
+    progress.update({'cache': 'hit', 'model': 'a'})
+    progress.update({'cache': 'miss', 'model': 'b', 'latency': 2.0, 'input_tokens': 100})
+    lines = progress.summary().splitlines()
+    assert lines[0].startswith('2 files in')
+    assert lines[lines.index('a:') + 1] == '  1 cached, 0 requests, 0 retries'
+    assert lines[lines.index('b:') + 1] == '  0 cached, 1 requests, 0 retries'
@@ -0,0 +1,48 @@
+from datetime import date
+
+import pytest
+
+from dawgtools import db, registry
+
+
+def test_packaged_queries():
+    specs = registry.load_registry()
+    assert set(specs) == {'notes', 'path_reports'}
+    assert db.list_queries() == list(specs)
+    notes = specs['notes']
+    assert notes.params['max_date'].type == 'date'
+    assert notes.params['max_date'].required
+    assert notes.fetch_size == 1000
+    assert db.get_query('notes') is notes.sql
+    assert specs['path_reports'].one_of == [['case_num', 'mrn']]
+
+
+def test_validate():
+    notes = registry.get('notes')
+    params = notes.validate({'epic_pat_id': 'Z1', 'min_date': '2024-01-01',
+                             'max_date': '2024-12-31', 'other': 'x'})
+    assert params == {'epic_pat_id': 'Z1', 'min_date': date(2024, 1, 1),
+                      'max_date': date(2024, 12, 31), 'other': 'x'}
+    with pytest.raises(ValueError, match='requires parameters: min_date, max_date'):
+        notes.validate({'epic_pat_id': 'Z1'})
+    with pytest.raises(ValueError, match='max_date'):
+        notes.validate({'epic_pat_id': 'Z1', 'min_date': '2024-01-01', 'max_date': '12/31/24'})
+    with pytest.raises(ValueError, match='one of the parameters: case_num, mrn'):
+        registry.get('path_reports').validate({})
+
+
+def test_front_matter(tmp_path):
+    (tmp_path / 'q.sql').write_text(
+        '-- description: a query\n'
+        '-- param: n int default=10\n'
+        '-- param: flag bool\n'
+        '-- format: csv\n'
+        '\n'
+        'select top (%(n)s) * from t\n'
+        '-- param: ignored\n')
+    spec = registry.load_registry(tmp_path)['q']
+    assert spec.description == 'a query'
+    assert list(spec.params) == ['n', 'flag']
+    assert spec.format == 'csv'
+    assert spec.fetch_size is None
+    assert spec.validate({'flag': 'yes'}) == {'n': 10, 'flag': True}
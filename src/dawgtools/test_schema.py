@@ -0,0 +1,45 @@
+import pytest
+
+from dawgtools.schema import compile_schema
+
+SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'smoker': {'type': 'boolean'},
+        'packs': {'type': ['integer', 'null'], 'minimum': 0},
+        'status': {'type': 'string', 'enum': ['current', 'former', 'never']},
+        'diagnoses': {'type': 'array', 'items': {'$ref': '#/$defs/diagnosis'}},
+    },
+    'required': ['smoker', 'status'],
+    'additionalProperties': False,
+    '$defs': {
+        'diagnosis': {
+            'type': 'object',
+            'properties': {'code': {'type': 'string', 'pattern': '^[A-Z]'}},
+            'required': ['code'],
+        },
+    },
+}
+
+
+def test_valid():
+    validate = compile_schema(SCHEMA)
+    assert validate({'smoker': True, 'status': 'current', 'packs': 2,
+                     'diagnoses': [{'code': 'C34'}]}) == []
+    assert validate({'smoker': False, 'status': 'never', 'packs': None}) == []
+
+
+@pytest.mark.parametrize('value,error', [
+    ({'status': 'never'}, "$: missing required property 'smoker'"),
+    ({'smoker': 'yes', 'status': 'never'}, '$.smoker: expected boolean, got string'),
+    ({'smoker': True, 'status': 'maybe'}, "$.status: 'maybe' is not one of"),
+    ({'smoker': True, 'status': 'never', 'packs': -1}, '$.packs: less than 0'),
+    ({'smoker': True, 'status': 'never', 'other': 1}, "$: unexpected property 'other'"),
+    ({'smoker': True, 'status': 'never', 'diagnoses': [{'code': 'C34'}, {'code': 1}]},
+     '$.diagnoses[1].code: expected string, got integer'),
+    ('text', '$: expected object, got string'),
+])
+def test_errors(value, error):
+    errors = compile_schema(SCHEMA)(value)
+    assert len(errors) == 1
+    assert errors[0].startswith(error)
@@ -0,0 +1,71 @@
+import csv
+import io
+import sys
+import textwrap
+
+import pytest
+
+from dawgtools.commands import _sql2csv
+
+# Stands in for the bcp utility: answers sp_describe_first_result_set
+# with the columns (id, name), and otherwise writes rows with ids in
+# the range given by 'id >= lo and id < hi' in the query (or 0-9).
+FAKE_BCP = textwrap.dedent('''
+    import re
+    import sys
+
+    query, verb, outfile = sys.argv[1:4]
+    opts = dict(zip(sys.argv[4::2], sys.argv[5::2]))
+    ft, rt = opts['-t'], opts['-r']
+
+    if query.startswith('exec sp_describe_first_result_set'):
+        rows = [['0', '2', 'name', '1'], ['0', '1', 'id', '0'], ['1', '3', 'hidden', '1']]
+    else:
+        mo = re.search(r'id >= (\\d+) and id < (\\d+)', query)
+        lo, hi = (int(x) for x in mo.groups()) if mo else (0, 10)
+        # NULL is written as an empty field; an empty string as NUL
+        names = {3: '', 4: '\\x00'}
+        rows = [[str(i), names.get(i, f'name, "{i}"\\nline2')] for i in range(lo, hi)]
+
+    with open(outfile, 'w', newline='') as f:
+        f.write(''.join(ft.join(row) + rt for row in rows))
+    print(f'{len(rows)} rows copied.')
+''')
+
+
+@pytest.fixture
+def bcp(tmp_path):
+    path = tmp_path / 'bcp'
+    path.write_text(f'#!{sys.executable}\n' + FAKE_BCP)
+    path.chmod(0o755)
+    return str(path)
+
+
+def expected_rows(ids):
+    return [[str(i), {3: '', 4: ''}.get(i, f'name, "{i}"\nline2')] for i in ids]
+
+
+def test_key_ranges():
+    assert _sql2csv.key_ranges(1, 10, 3) == [(1, 4), (4, 7), (7, 11)]
+    assert _sql2csv.key_ranges(1, 2, 4) == [(1, 2), (2, 3)]
+
+
+def test_bcp_export(bcp):
+    f = io.StringIO()
+    _sql2csv.bcp_export('select id, name from t', f, bcp=bcp)
+    rows = list(csv.reader(io.StringIO(f.getvalue())))
+    assert rows == [['id', 'name']] + expected_rows(range(10))
+
+
+def test_bcp_export_parallel(bcp):
+    f = io.StringIO()
+    query = 'select id, name from t where id >= {key_lo} and id < {key_hi}'
+    _sql2csv.bcp_export(query, f, bcp=bcp, ranges=_sql2csv.key_ranges(5, 24, 3))
+    rows = list(csv.reader(io.StringIO(f.getvalue())))
+    assert rows == [['id', 'name']] + expected_rows(range(5, 25))
+
+
+def test_read_bcp_chunks(tmp_path):
+    path = tmp_path / 'data'
+    path.write_text('a\x1fb\x1ec\x1fd\x1e')
+    assert list(_sql2csv.read_bcp(str(path), chunk_size=3)) == [['a', 'b'], ['c', 'd']]
@@ -0,0 +1,43 @@
+import io
+import json
+from datetime import datetime
+
+import pytest
+
+from dawgtools.utils import MyJSONEncoder, iter_json_array, iter_json_rows
+
+ROWS = [
+    [1, 'a\nb', None, datetime(2024, 1, 2)],
+    [2, {'nested': [1, 2]}, [], 'c'],
+]
+HEADERS = ['w', 'x', 'y', 'z']
+
+
+@pytest.mark.parametrize('items', [[], [1], [dict(zip(HEADERS, row)) for row in ROWS]])
+def test_iter_json_array(items):
+    assert ''.join(iter_json_array(iter(items))) == \
+        json.dumps(items, indent=2, cls=MyJSONEncoder)
+    assert ''.join(iter_json_array(iter(items), indent=None)) == \
+        json.dumps(items, separators=(',', ':'), cls=MyJSONEncoder)
+
+
+@pytest.mark.parametrize('rows', [[], ROWS])
+def test_iter_json_rows(rows):
+    obj = dict(fieldnames=HEADERS, data=rows)
+    assert ''.join(iter_json_rows(HEADERS, iter(rows))) == \
+        json.dumps(obj, indent=2, cls=MyJSONEncoder)
+    assert ''.join(iter_json_rows(HEADERS, iter(rows), indent=None)) == \
+        json.dumps(obj, separators=(',', ':'), cls=MyJSONEncoder)
+
+
+def test_streaming():
+    def rows():
+        yield {'a': 1}
+        # the first element is written before the iterator is exhausted
+        assert f.getvalue().startswith('[\n  {')
+        yield {'a': 2}
+
+    f = io.StringIO()
+    for chunk in iter_json_array(rows()):
+        f.write(chunk)
+    assert json.loads(f.getvalue()) == [{'a': 1}, {'a': 2}]
@@ -1,6 +1,7 @@
 import sys
 from datetime import datetime
 from decimal import Decimal
+from typing import Iterable, Iterator
 import json
 
 
@@ -23,4 +24,57 @@ class MyJSONEncoder(json.JSONEncoder):
         elif isinstance(obj, Decimal):
             return int(obj)
 
-        return super().default(obj)
\ No newline at end of file
+        return super().default(obj)
+
+
+def _encoder(indent: int | None, cls=MyJSONEncoder) -> json.JSONEncoder:
+    # compact output omits all whitespace
+    return cls(indent=indent, separators=(',', ': ') if indent is not None else (',', ':'))
+
+
+def iter_json_array(items: Iterable, indent: int | None = 2, level: int = 0,
+                    cls=MyJSONEncoder) -> Iterator[str]:
+    """Yields chunks of text encoding `items` as a JSON array one
+    element at a time. With `indent`, the output is the same as
+    json.dumps(list(items), indent=indent) for an array nested `level`
+    levels deep; otherwise, the output is compact.
+
+    """
+
+    encoder = _encoder(indent, cls)
+    if indent is None:
+        start, sep, end = '[', ',', ']'
+    else:
+        pad = '\n' + ' ' * indent * (level + 1)
+        start, sep, end = '[' + pad, ',' + pad, '\n' + ' ' * indent * level + ']'
+
+    first = True
+    for item in items:
+        text = encoder.encode(item)
+        if indent is not None:
+            # newlines within strings are escaped, so any newline is formatting
+            text = text.replace('\n', pad)
+        yield (start if first else sep) + text
+        first = False
+
+    yield '[]' if first else end
+
+
+def iter_json_rows(headers: list, rows: Iterable, indent: int | None = 2,
+                   cls=MyJSONEncoder) -> Iterator[str]:
+    """Yields chunks of text encoding an object {"fieldnames": headers,
+    "data": rows} with rows encoded one at a time as described for
+    iter_json_array().
+
+    """
+
+    if indent is None:
+        yield '{"fieldnames":' + _encoder(None, cls).encode(headers) + ',"data":'
+        yield from iter_json_array((list(row) for row in rows), None, cls=cls)
+        yield '}'
+    else:
+        pad = '\n' + ' ' * indent
+        fieldnames = ''.join(iter_json_array(headers, indent, level=1, cls=cls))
+        yield '{' + pad + '"fieldnames": ' + fieldnames + ',' + pad + '"data": '
+        yield from iter_json_array((list(row) for row in rows), indent, level=1, cls=cls)
+        yield '\n}'